@@ -132,6 +132,8 @@ class BaseAsyncImage:
         self.context = context
         self.url = url
         self.reader = None
+        self.decoder = None
+        self.decode_synchronously = 0
         self.loaded = 0
         self.headers = {}
         if reload:
@@ -149,9 +151,13 @@ class BaseAsyncImage:
             True if the image was loaded successfully, False otherwise.
         """
         if not self.loaded:
-            self.start_loading(context)
-            if self.reader:
-                self.reader.geteverything()
+            self.decode_synchronously = 1
+            try:
+                self.start_loading(context)
+                if self.reader:
+                    self.reader.geteverything()
+            finally:
+                self.decode_synchronously = 0
         return self.loaded
 
     def start_loading(self, context=None, reload=0):
@@ -164,10 +170,12 @@ class BaseAsyncImage:
         # seems that the reload=1 when you click on an image that
         # you had stopped loading
         if context: self.context = context
-        if self.reader:
+        if self.reader or self.decoder:
             return
         try:
-            api = self.context.app.open_url(self.url, 'GET', self.headers,
+            params = self.headers.copy()
+            params['.priority'] = 'image'
+            api = self.context.app.open_url(self.url, 'GET', params,
                                             self.reload or reload) 
         except IOError as msg:
             self.show_bad()
@@ -186,6 +194,8 @@ class BaseAsyncImage:
 
     def stop_loading(self):
         """Stops loading the image."""
+        if self.decoder:
+            self.decoder.kill()
         if not self.reader:
             return
         self.reader.kill()
@@ -205,6 +215,7 @@ class BaseAsyncImage:
             self.show_bad()
         else:
             self.loaded = 1
+            self.context.app.image_cache.image_resized(self)
 
     def do_color_magic(self):
         """Sets the transparent color for GIFs."""
@@ -232,7 +243,7 @@ class BaseAsyncImage:
         Returns:
             A string: 'loading' or 'idle'.
         """
-        if self.reader:
+        if self.reader or self.decoder:
             return 'loading'
         else:
             return 'idle'
@@ -314,6 +325,46 @@ class PILAsyncImageSupport(BaseAsyncImage):
         # Make sure these are integers
         self.__width = width or 0
         self.__height = height or 0
+        self.__requested = (self.__width, self.__height)
+
+    def start_loading(self, context=None, reload=0):
+        """Starts loading the image, from a decoded thumbnail if the
+        disk cache has a valid one.
+
+        Args:
+            context: An optional URI context.
+            reload: An optional flag indicating a reload.
+        """
+        if context: self.context = context
+        if self.reader or self.decoder:
+            return
+        if not (self.reload or reload):
+            width, height = self.__requested
+            thumbnail = self.context.app.url_cache.thumbnail_file(
+                self.url, width, height, self.background())
+            if thumbnail:
+                if self.decode_synchronously:
+                    self.thumbnail_loaded(load_thumbnail(*thumbnail))
+                else:
+                    self.decoder = ImageDecoder(self, self.thumbnail_loaded,
+                                                load_thumbnail, thumbnail)
+                return
+        BaseAsyncImage.start_loading(self, context, reload)
+
+    def thumbnail_loaded(self, im):
+        """Shows a thumbnail, or loads the image if it was unusable."""
+        if im is None:
+            self.decoder = None
+            BaseAsyncImage.start_loading(self)
+        else:
+            self.decoded(im, 0)
+
+    def background(self):
+        """Returns the viewer background as a 3-tuple of 8-bit values."""
+        r, g, b = self.context.viewer.text.winfo_rgb(
+            self.context.viewer.text["background"])
+        # convert these to 8-bit versions
+        return (r // 256, g // 256, b // 256)
 
     def blank(self):
         """Blanks the image."""
@@ -330,47 +381,45 @@ class PILAsyncImageSupport(BaseAsyncImage):
     def set_file(self, filename):
         """Sets the image from a file, handling resizing and transparency.
 
+        The file is decoded, composited and scaled by decode_image() on
+        the decoder pool; only the final paste happens here, on the Tk
+        thread, when the ImageDecoder hands the result back.  Images
+        loaded synchronously are decoded in place.
+
         Args:
             filename: The path to the image file.
         """
-        import Image
         try:
-            im = Image.open(filename)
-            im.load()                   # force loading to catch IOError
-        except (IOError, ValueError):
-            # either of these may occur during decoding...
+            # Open it now: the reader removes its temporary file as
+            # soon as we return.
+            fp = open(filename, 'rb')
+        except IOError:
             return self.show_bad()
-        if im.format == "XBM":
-            im = xbm_to_rgba(im)
-        real_size = im.size
-        # determine desired size:
-        if self.__width and not self.__height and self.__width != im.size[0]:
-            # scale horizontally
-            self.__height = int(1.0 * im.size[1] * self.__width / im.size[0])
-        elif self.__height and not self.__width \
-             and self.__height != im.size[1]:
-            # scale vertically
-            self.__width = int(1.0 * im.size[0] * self.__height / im.size[1])
+        args = (fp, self.__width, self.__height, self.background())
+        if self.decode_synchronously:
+            self.decoded(decode_image(*args))
         else:
-            self.__width = self.__width or im.size[0]
-            self.__height = self.__height or im.size[1]
-        # transparency stuff
-        if im.mode == "RGBA" \
-           or (im.mode == "P" and im.info.has_key("transparency")):
-            r, g, b = self.context.viewer.text.winfo_rgb(
-                self.context.viewer.text["background"])
-            r = r / 256                 # convert these to 8-bit versions
-            g = g / 256
-            b = b / 256
-            if im.mode == "P":
-                im = p_to_rgb(im, (r, g, b))
-            else:
-                im = rgba_to_rgb(im, (r, g, b))
-        #
-        if real_size != (self.__width, self.__height):
-            w, h = real_size
-            if w != self.__width or h != self.__height:
-                im = im.resize((self.__width, self.__height))
+            self.decoder = ImageDecoder(self, self.decoded,
+                                        decode_image, args)
+
+    def decoded(self, im, store=1):
+        """Pastes a decoded image; called on the Tk thread.
+
+        Args:
+            im: The image returned by decode_image(), or None if it
+                could not be decoded.
+            store: Whether to save the image as a thumbnail.
+        """
+        self.decoder = None
+        if im is None:
+            return self.show_bad()
+        if store:
+            width, height = self.__requested
+            thumbnail = self.context.app.url_cache.thumbnail_file(
+                self.url, width, height, self.background())
+            if thumbnail:
+                decode_pool().submit(save_thumbnail, im, *thumbnail)
+        self.__width, self.__height = im.size
         # This appears to be absolutely necessary, but I'm not sure why....
         self._PhotoImage__size = im.size
         self.blank()
@@ -378,6 +427,8 @@ class PILAsyncImageSupport(BaseAsyncImage):
         w, h = im.size
         self.image['width'] = w
         self.image['height'] = h
+        self.loaded = 1
+        self.context.app.image_cache.image_resized(self)
 
     def width(self):
         """Gets the width of the image."""
@@ -394,6 +445,158 @@ class PILAsyncImageSupport(BaseAsyncImage):
         self.image[key] = value
 
 
+# Tuning parameters for the decoder pool
+DECODE_WORKERS = 4                      # Threads decoding images
+POLLTIME = 20                           # Milliseconds between checks
+
+_decode_pool = None
+
+def decode_image(fp, width, height, background):
+    """Opens, decodes, composites and scales an image.
+
+    This runs on a decoder pool thread, so it must not touch Tk.
+
+    Args:
+        fp: An open file containing the image; it is closed.
+        width: The desired width, or 0 to keep the image's (or scale
+            in proportion to height).
+        height: The desired height, or 0 likewise.
+        background: The RGB-value to use for transparent areas, a
+            3-tuple of 8-bit integers.
+
+    Returns:
+        An RGB (or grey scale) image of the final size, or None if the
+        file could not be decoded.
+    """
+    import Image
+    try:
+        try:
+            im = Image.open(fp)
+            im.load()                   # force loading to catch IOError
+        except (IOError, ValueError):
+            # either of these may occur during decoding...
+            return None
+    finally:
+        fp.close()
+    if im.format == "XBM":
+        im = xbm_to_rgba(im)
+    real_size = im.size
+    # determine desired size:
+    if width and not height and width != im.size[0]:
+        # scale horizontally
+        height = int(1.0 * im.size[1] * width / im.size[0])
+    elif height and not width and height != im.size[1]:
+        # scale vertically
+        width = int(1.0 * im.size[0] * height / im.size[1])
+    else:
+        width = width or im.size[0]
+        height = height or im.size[1]
+    # transparency stuff
+    if im.mode == "RGBA" \
+       or (im.mode == "P" and im.info.has_key("transparency")):
+        if im.mode == "P":
+            im = p_to_rgb(im, background)
+        else:
+            im = rgba_to_rgb(im, background)
+    #
+    if real_size != (width, height):
+        im = im.resize((width, height))
+    return im
+
+
+def load_thumbnail(path, validator):
+    """Reads a decoded thumbnail; returns an image or None."""
+    from CacheMgr import read_thumbnail
+    thumbnail = read_thumbnail(path, validator)
+    if not thumbnail:
+        return None
+    import Image
+    mode, size, data = thumbnail
+    try:
+        return Image.fromstring(mode, size, data)
+    except ValueError:
+        return None
+
+
+def save_thumbnail(im, path, validator):
+    """Stores a decoded image as a thumbnail."""
+    from CacheMgr import write_thumbnail
+    write_thumbnail(path, validator, im.mode, im.size, im.tostring())
+
+
+def decode_pool():
+    """Returns the decoder pool, starting it on first use."""
+    global _decode_pool
+    if _decode_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _decode_pool = ThreadPoolExecutor(DECODE_WORKERS)
+    return _decode_pool
+
+
+class ImageDecoder:
+    """Runs a decoding function for an image on the decoder pool.
+
+    The decoder registers with the image's Context like a reader, so
+    the Stop button stays active while it runs and Context.stop()
+    cancels it.  Its result is polled for from the Tk main loop and
+    handed to callback (e.g. the image's decoded() method).
+
+    Attributes:
+        image: The PILAsyncImage being decoded.
+        context: The URI context.
+        callback: The function receiving the decoded image or None.
+        future: The pending decode_image() or load_thumbnail() call.
+        nbytes, maxbytes, message, api: For the Context's status line.
+    """
+
+    nbytes = 0
+    maxbytes = 0
+    message = "decoding image"
+    api = None
+
+    def __init__(self, image, callback, function, args):
+        self.image = image
+        self.context = image.context
+        self.callback = callback
+        self.future = decode_pool().submit(function, *args)
+        self.context.addreader(self)
+        self.context.root.after(POLLTIME, self.poll)
+
+    def __str__(self):
+        return "%s: %s" % (self.image.url, self.message)
+
+    def poll(self):
+        if not self.image:
+            return
+        if not self.future.done():
+            self.context.root.after(POLLTIME, self.poll)
+            return
+        callback = self.callback
+        self.stop()
+        try:
+            im = self.future.result()
+        except Exception:
+            im = None
+        callback(im)
+
+    def stop(self):
+        self.image = None
+        self.callback = None
+        if self.context:
+            self.context.rmreader(self)
+            self.context = None
+
+    def kill(self):
+        """Cancels the decode; a running one is left to finish unseen."""
+        image = self.image
+        if not image:
+            return
+        self.future.cancel()
+        self.stop()
+        image.decoder = None
+        image.show_bad()
+
+
 def p_to_rgb(im, rgb):
     """Translates a P-mode image with transparency to an RGB image.
 
@@ -499,3 +702,61 @@ def AsyncImage(context, url, reload=0, **kw):
     else:
         AsyncImage = TkAsyncImage
     return AsyncImage(context, url, reload, **kw)
+
+
+def benchmark(n=100, size=(800, 600), directory=None):
+    """Times decoding a page of n JPEG images on the Tk thread and on
+    the decoder pool.
+
+    The images, and an index.html showing them all scaled, are written
+    to directory (a new temporary directory by default) so the same
+    page can be loaded into Grail.
+    """
+    import tempfile
+    import time
+    import Image
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    names = []
+    for i in range(n):
+        name = "image%03d.jpg" % i
+        im = Image.new("RGB", size, (i * 2 % 256, 128, 255 - i % 256))
+        im.save(os.path.join(directory, name), "JPEG")
+        names.append(name)
+    f = open(os.path.join(directory, "index.html"), "w")
+    f.write("<TITLE>%d images</TITLE>\n" % n)
+    for name in names:
+        f.write('<IMG SRC="%s" WIDTH=%d>\n' % (name, size[0] // 4))
+    f.close()
+    print("Benchmark page:", os.path.join(directory, "index.html"))
+    paths = [os.path.join(directory, name) for name in names]
+    width = size[0] // 4
+    background = (255, 255, 255)
+
+    t0 = time.time()
+    for path in paths:
+        decode_image(open(path, 'rb'), width, 0, background)
+    serial = time.time() - t0
+
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(DECODE_WORKERS)
+    t0 = time.time()
+    futures = []
+    for path in paths:
+        futures.append(pool.submit(decode_image, open(path, 'rb'),
+                                   width, 0, background))
+    blocked = time.time() - t0
+    for future in futures:
+        future.result()
+    pooled = time.time() - t0
+    pool.shutdown()
+
+    print("%d images of %dx%d scaled to width %d:" % (n, size[0], size[1],
+                                                      width))
+    print("  main thread decode: %.3f sec, all of it blocking Tk" % serial)
+    print("  pool of %d threads: %.3f sec, %.3f sec blocking Tk"
+          % (DECODE_WORKERS, pooled, blocked))
+
+
+if __name__ == '__main__':
+    benchmark()
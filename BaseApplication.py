@@ -17,6 +17,7 @@ import grailbase.mtloader
 import grailbase.utils
 
 import sgml.extloader
+import sgml.HTMLParser
 
 # make extension packages from these:
 import filetypes
@@ -54,6 +55,12 @@ class BaseApplication(grailbase.app.Application):
         # cache of available extensions
         self.__extensions = {}
 
+    def add_loader(self, name, loader):
+        grailbase.app.Application.add_loader(self, name, loader)
+        if name[:5] == "html.":
+            # parsers share tag tables built from the html.* loaders
+            sgml.HTMLParser.flush_taginfo_tables()
+
     def find_type_extension(self, package, mimetype):
         """Finds a handler for a given MIME type within a package.
 
@@ -10,6 +10,7 @@ import grailutil
 # Default tuning parameters
 # BUFSIZE = 8*1024                      # Buffer size for api.getdata()
 BUFSIZE = 512                           # Smaller size for better response
+MAXBUFSIZE = 16*1024                    # Largest size bufsize grows to
 SLEEPTIME = 100                         # Milliseconds between regular checks
 
 class BaseReader:
@@ -23,7 +24,10 @@ class BaseReader:
         api: The URL API object.
         callback: The current callback function.
         poller: The current poller function.
-        bufsize: The buffer size for reading data.
+        bufsize: The buffer size for reading data.  It starts at BUFSIZE
+            so the first data is shown quickly, and doubles (up to
+            maxbufsize) each time a read fills it, so a fast transfer
+            is handled in fewer, larger pieces.
         nbytes: The number of bytes read so far.
         maxbytes: The total number of bytes to read.
         shorturl: A shortened version of the URL for display.
@@ -34,6 +38,7 @@ class BaseReader:
 
     # Tuning parameters
     sleeptime = SLEEPTIME
+    maxbufsize = MAXBUFSIZE
 
     def __init__(self, context, api):
         """Initializes the BaseReader.
@@ -58,6 +63,7 @@ class BaseReader:
 
         self.fno = None   # will be assigned by start
         self.killed = None
+        self.recheck_pending = 0
 
         # Only http_access has delayed startup property.
         # Second argument would allow implementation of persistent
@@ -86,6 +92,9 @@ class BaseReader:
         if self.killed:
             print "start() called after a kill"
             return
+        if self.fno is not None and self.fno >= 0:
+            # called again because the API changed sockets
+            tkinter.deletefilehandler(self.fno)
         self.fno = self.api.fileno()
         if TkVersion == 4.0 and sys.platform == 'irix5':
             if self.fno >= 20: self.fno = -1 # XXX for SGI Tk OPEN_MAX bug
@@ -247,8 +256,23 @@ class BaseReader:
             self.handle_eof()
             self.stop()
             return
+        if len(data) >= self.bufsize and self.bufsize < self.maxbufsize:
+            # More is probably waiting; ask for more next time
+            self.bufsize = min(2 * self.bufsize, self.maxbufsize)
         self.update_nbytes(data)
         self.handle_data(data)
+        if self.fno >= 0 and self.api and not self.recheck_pending \
+           and self.api.polldata()[1]:
+            # Data may be waiting where the file handler can't see it,
+            # e.g. the end of a response on a kept-alive connection.
+            self.recheck_pending = 1
+            self.context.root.after_idle(self.recheck)
+
+    def recheck(self):
+        """Idle callback scheduled by getapidata()."""
+        self.recheck_pending = 0
+        if self.callback:
+            self.checkapi()
 
     def geteverything(self):
         """Reads all data from the URL synchronously."""
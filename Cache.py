@@ -16,6 +16,7 @@ import os
 import protocols
 import time
 import copy
+from bisect import bisect_right
 
 class SharedItem:
     """A shareable, cached item.
@@ -34,7 +35,7 @@ class SharedItem:
         reloading: A flag indicating a forced reload.
         data: A list of data chunks.
         datalen: The total length of the data.
-        datamap: A map of offsets to data chunks.
+        offsets: The starting offset of each chunk in data, ascending.
         complete: A flag indicating whether the item is completely loaded.
         api: The protocol API object for this item.
         stage: The current loading stage (META, DATA, or DONE).
@@ -71,7 +72,7 @@ class SharedItem:
         self.reloading = 0
         self.data = []
         self.datalen = 0
-        self.datamap = {}
+        self.offsets = []
         self.complete = 0
 
         # initialize in one of four states
@@ -211,41 +212,26 @@ class SharedItem:
         Assert(offset >= 0)
         Assert(maxbytes > 0)
 
+        if self.stage == META:
+            self.getmeta()
         while self.stage == DATA and offset >= self.datalen:
             buf = self.api.getdata(maxbytes)
             if not buf:
                 self.finish()
                 self.complete = 1
             else:
-                l = len(buf)
-                if l > maxbytes:
-                    # we got more than we wanted,
-                    # so split into two strings (avoid search next time)
-                    self.data.append(buf[:maxbytes])
-                    self.datamap[offset] = len(self.data) - 1
-                    self.data.append(buf[maxbytes:])
-                    self.datamap[offset+maxbytes] = len(self.data) - 1
-                else:
-                    self.data.append(buf)
-                    self.datamap[offset] = len(self.data) - 1
-                self.datalen = self.datalen + l
-
-        try:
+                self.data.append(buf)
+                self.offsets.append(self.datalen)
+                self.datalen = self.datalen + len(buf)
+
+        if offset >= self.datalen:
+            return ''
+        index, delta = self._find_chunk(offset)
+        chunk = self.data[index]
+        if delta == 0 and len(chunk) <= maxbytes:
             # the common case
-            chunk = self.data[self.datamap[offset]]
-            if len(chunk) > maxbytes:
-                return chunk[0:maxbytes]
-            else:
-                return chunk
-        except KeyError:
-            if self.stage == META:
-                self.meta = self.api.getmeta()
-                self.stage = DATA
-            elif self.complete == 1 and offset >= self.datalen:
-                return ''
-            chunk_key, delta = self._getdata_search_string_list(offset)
-            chunk = self.data[self.datamap[chunk_key]]
-            return chunk[delta:]
+            return chunk
+        return chunk[delta:delta+maxbytes]
 
     def fileno(self):
         """Gets the file number of the underlying socket, if available."""
@@ -274,29 +260,20 @@ class SharedItem:
         if api:
             api.close()
 
-    def _getdata_search_string_list(self, offset):
-        """Finds the data chunk for a given offset.
+    def _find_chunk(self, offset):
+        """Finds the data chunk containing a given offset.
 
-        This is a slow operation and should be avoided.
+        Readers sharing the item may be at any offset, so this is a
+        binary search over the chunk offsets: O(log k) for k chunks.
 
         Args:
-            offset: The offset to find.
+            offset: The offset to find; must be less than datalen.
 
         Returns:
-            A tuple of (chunk_key, delta).
+            A tuple of (index into data, offset within that chunk).
         """
-        ### WARNING: this lookup is costly, please avoid
-        ###          cost is O(k), where k is # of chunks
-        ###          if you use this a lot, you'll get O(N^2) reads
-        delta = offset
-        chunk_key = None
-        for chunk_offset in self.datamap.keys():
-            if offset > chunk_offset:
-                diff = offset - chunk_offset
-                if diff <= delta:
-                    delta = diff
-                    chunk_key = chunk_offset
-        return chunk_key, delta
+        index = bisect_right(self.offsets, offset) - 1
+        return index, offset - self.offsets[index]
 
     def init_new_load(self,stage):
         """Initializes the item for a new network load.
@@ -307,7 +284,7 @@ class SharedItem:
         self.meta = None
         self.data = []
         self.datalen = 0
-        self.datamap = {}
+        self.offsets = []
         self.stage = stage
         self.complete = 0
 
@@ -491,5 +468,60 @@ def test():
         api.close()
 
 
+class _BenchAPI:
+    """Protocol API stand-in that yields a fixed list of chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.state = DATA
+
+    def getmeta(self):
+        return 200, "OK", {}
+
+    def polldata(self):
+        return "Ready", 1
+
+    def getdata(self, maxbytes):
+        if self.chunks:
+            return self.chunks.pop(0)
+        return ''
+
+    def close(self):
+        pass
+
+
+def benchmark(nchunks=1000, nreaders=10):
+    """Time readers sharing one SharedItem at unaligned offsets.
+
+    Each reader uses a different read size, so after the first few
+    reads none of them is at a chunk boundary.
+    """
+    chunks = []
+    for i in range(nchunks):
+        chunks.append('x' * (256 + (i * 37) % 512))
+    item = SharedItem('bench:', 'GET', {}, None, 'bench:',
+                      api=_BenchAPI(chunks))
+    readers = []
+    for i in range(nreaders):
+        api = SharedAPI(item)
+        api.getmeta()
+        readers.append((api, 100 + 61 * i))
+    t0 = time.time()
+    reads = 0
+    while readers:
+        for reader in readers[:]:
+            api, size = reader
+            if api.getdata(size):
+                reads = reads + 1
+            else:
+                readers.remove(reader)
+    t1 = time.time()
+    print("%d reads over %d chunks in %.3f sec" % (reads, nchunks, t1 - t0))
+
+
 if __name__ == '__main__':
-    test()
+    import sys
+    if sys.argv[1:] == ['-b']:
+        benchmark()
+    else:
+        test()
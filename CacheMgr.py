@@ -8,6 +8,13 @@ import ht_time
 import grailutil
 import mimetypes
 import regex
+import re
+import hashlib
+import heapq
+import struct
+import threading
+import zlib
+from collections import OrderedDict
 
 META, DATA, DONE = 'META', 'DATA', 'DONE' # Three stages
 
@@ -59,6 +66,7 @@ class CacheManager:
         items: A dictionary of all items in the cache.
         active: A dictionary of currently active items.
         disk: The disk cache object.
+        hot: The MemoryCache holding small objects in front of disk.
         fresh_p: A function that determines if an item is fresh.
         session_freshen: A list of items that have been freshened in the
             current session.
@@ -76,9 +84,13 @@ class CacheManager:
         self.items = {}
         self.active = {}
         self.disk = None
+        self.hot = MemoryCache(
+            self.app.prefs.GetInt('disk-cache', 'memory-size') * 1024,
+            self.app.prefs.GetInt('disk-cache', 'memory-max-object') * 1024)
         self.disk = DiskCache(self, self.app.prefs.GetInt('disk-cache',
                                                      'size') * 1024,
-                         self.app.prefs.Get('disk-cache', 'directory'))
+                         self.app.prefs.Get('disk-cache', 'directory'),
+                         self.app.prefs.Get('disk-cache', 'log-durability'))
         self.set_freshness_test()
         self.app.prefs.AddGroupCallback('disk-cache', self.update_prefs)
 
@@ -86,18 +98,33 @@ class CacheManager:
         bool = self.app.prefs.GetInt('disk-cache', 'checkpoint')
         if bool:
             self.app.register_on_exit(lambda save=self.save_cache_state:save())
+        else:
+            self.app.register_on_exit(lambda flush=self.flush_cache_logs:
+                                      flush())
 
     def save_cache_state(self):
         """Saves the state of all caches."""
         for cache in self.caches:
             cache._checkpoint_metadata()
 
+    def flush_cache_logs(self):
+        """Writes out any log records the caches are still batching."""
+        for cache in self.caches:
+            cache.flush_log()
+
     def update_prefs(self):
         """Updates the cache manager's settings from the preferences."""
         self.set_freshness_test()
         size = self.caches[0].max_size = self.app.prefs.GetInt('disk-cache',
                                                                'size') \
                                                                * 1024
+        self.disk.log_durability = self.app.prefs.Get('disk-cache',
+                                                      'log-durability')
+        self.hot.resize(
+            self.app.prefs.GetInt('disk-cache', 'memory-size') * 1024,
+            self.app.prefs.GetInt('disk-cache', 'memory-max-object') * 1024)
+        self.disk.thumbnails.resize(
+            self.app.prefs.GetInt('disk-cache', 'thumbnail-size') * 1024)
         new_dir = self.app.prefs.Get('disk-cache', 'directory')
         if new_dir != self.disk.pref_dir:
             self.disk._checkpoint_metadata()
@@ -115,8 +142,9 @@ class CacheManager:
             size = self.disk.max_size
         if not dir:
             dir = self.disk.directory
+        durability = self.disk.log_durability
         self.disk.close(flush_log)
-        self.disk = DiskCache(self, size, dir)
+        self.disk = DiskCache(self, size, dir, durability)
         
     def set_freshness_test(self):
         """Sets the freshness test function based on user preferences."""
@@ -253,14 +281,46 @@ class CacheManager:
         Args:
             key: The cache key of the item to read.
 
+        Small objects are served from the in-memory tier when they
+        are there.
+
         Returns:
             A protocol API object for the item, or None if not found.
         """
         if key in self.items:
-            return self.items[key].get()
+            return self.items[key].get(self.hot)
         else:
             return None
 
+    def thumbnail_file(self, url, width, height, background):
+        """Locates the decoded-thumbnail file for a scaled image.
+
+        Args:
+            url: The URL of the source image.
+            width: The requested width (0 if unconstrained).
+            height: The requested height (0 if unconstrained).
+            background: The RGB 3-tuple transparent areas are
+                composited onto.
+
+        Returns:
+            A (path, validator) pair for read_thumbnail() and
+            write_thumbnail(), or None when the source image is not in
+            the disk cache, is no longer fresh, or thumbnails are
+            turned off.
+        """
+        if not self.app.prefs.GetBoolean('disk-cache', 'thumbnails'):
+            return None
+        key = self.url2key(url, 'GET', {})
+        if key not in self.items or not self.fresh_p(key):
+            return None
+        entry = self.items[key]
+        return entry.cache.thumbnails.lookup(entry, width, height,
+                                             background)
+
+    def hot_cache_stats(self):
+        """Returns the in-memory tier's counters as a dictionary."""
+        return self.hot.stats()
+
     def touch(self,key=None,url=None,refresh=0):
         """Updates the last-used timestamp for a cache item.
 
@@ -291,6 +351,9 @@ class CacheManager:
         if type(keys) != type([]):
             keys = [keys]
 
+        for key in keys:
+            self.hot.discard(key)
+
         if evict:
             for key in keys:
                 try:
@@ -312,10 +375,13 @@ class CacheManager:
             reload: A flag indicating a reload.
         """
         try:
+            entry = None
             if item.key not in self.items and self.okay_to_cache_p(item):
-                self.caches[0].add(item)
+                entry = self.caches[0].add(item)
             elif reload == 1:
-                self.caches[0].update(item)
+                entry = self.caches[0].update(item)
+            if entry and item.datalen <= self.hot.max_object:
+                self.hot.add(entry, b''.join(item.data))
         except CacheFileError as err_tuple:
             (file, err) = err_tuple
             print("error adding item %s (file %s): %s" % (item.url,
@@ -441,6 +507,21 @@ class CacheManager:
         return urlparse.urlunparse((scheme, netloc, path, params, query, ""))
 
 
+def key_shard(key):
+    """Return the two-level cache subdirectory for a key, e.g. '3f/a0'."""
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return digest[:2] + '/' + digest[2:4]
+
+
+# Binary log records are a (kind, payload length) header followed by
+# the payload.  Kinds are 0 add, 1 delete, 2 use-order update.
+log_record = struct.Struct('>BI')
+
+def pack_log_record(kind, payload):
+    """Return a binary log record for the payload bytes."""
+    return log_record.pack(kind, len(payload)) + payload
+
+
 class DiskCacheEntry:
     """Data about item stored in a disk cache.
 
@@ -536,11 +617,55 @@ class DiskCacheEntry:
         s = string.join(map(str, stuff), '\t')
         return s
 
-    def get(self):
+    # fixed-layout head of a packed entry: size, date, lastmod and
+    # expires (in seconds, 0 for None), then the byte lengths of the
+    # six strings that follow it
+    packed_fixed = struct.Struct('>Qddd6I')
+
+    def pack(self):
+        """Return entry as a binary log record payload."""
+        if not hasattr(self, 'file'):
+            self.file = ''
+        secs = []
+        for t in (self.date, self.lastmod, self.expires):
+            secs.append(t and t.get_secs() or 0.0)
+        strings = []
+        for s in (self.key, self.url, self.file, self.type, self.encoding,
+                  self.transfer_encoding):
+            strings.append((s or '').encode('utf-8'))
+        lengths = map(len, strings)
+        return self.packed_fixed.pack(self.size, *(secs + list(lengths))) \
+               + b''.join(strings)
+
+    def unpack(self, buf, offset):
+        """Reads a binary log record payload starting at offset."""
+        (self.size, date, lastmod, expires,
+         n0, n1, n2, n3, n4, n5) = self.packed_fixed.unpack_from(buf, offset)
+        offset = offset + self.packed_fixed.size
+        data = buf[offset:offset+n0+n1+n2+n3+n4+n5]
+        i = n0 + n1
+        j = i + n2
+        k = j + n3
+        l = k + n4
+        self.key = data[:n0].decode('utf-8')
+        self.url = data[n0:i].decode('utf-8')
+        self.file = data[i:j].decode('utf-8')
+        self.type = data[j:k].decode('utf-8')
+        self.encoding = data[k:l].decode('utf-8') or None
+        self.transfer_encoding = data[l:].decode('utf-8') or None
+        self.date = date and HTTime(secs=date) or None
+        self.lastmod = lastmod and HTTime(secs=lastmod) or None
+        self.expires = expires and HTTime(secs=expires) or None
+
+    def get(self, hot=None):
         """Create a disk_cache_access API object and return it.
 
         Calls cache.get() to update the LRU information.
 
+        If hot (a MemoryCache) holds this entry's bytes, or the entry
+        is small enough to be read into it now, a memory_cache_access
+        serving those bytes is returned instead.
+
         Also checks to see if a page with an explicit Expire date has
         expired; raises a CacheReadFaile if it has.
         """
@@ -549,6 +674,21 @@ class DiskCacheEntry:
                 # we need to refresh the page; can we just reload?
                 raise CacheReadFailed, self.cache
         self.cache.get(self.key) 
+        path = self.cache.get_file_path(self.file)
+        if hot is not None:
+            data = hot.get(self)
+            if data is None and self.size <= hot.max_object:
+                try:
+                    f = open(path, 'rb')
+                    data = f.read()
+                    f.close()
+                except IOError:
+                    raise CacheReadFailed, self.cache
+                hot.add(self, data)
+            if data is not None:
+                return memory_cache_access(path, data, self.type, self.date,
+                                           self.encoding,
+                                           self.transfer_encoding)
         try:
             api = disk_cache_access(self.cache.get_file_path(self.file),
                                     self.type, self.date, self.size,
@@ -566,39 +706,43 @@ class DiskCacheEntry:
     def delete(self):
         pass
 
-def compare_expire_items(item1,item2):
-    """used with list.sort() to sort list of CacheEntries by expiry date."""
-    e1 = item1.expires.get_secs() 
-    e2 = item2.expires.get_secs()
-    if e1 > e2:
-        return 1
-    elif e2 > e1:
-        return -1
-    else:
-        return 0
-
 class DiskCache:
     """Persistent object cache.
 
     need to discuss:
 
-    use_order
-
-    the log: writes every change to cache or use_order, writes
-    flushed, do a checkpoint run on startup, format is tuple (entry
-    type, object), where entry type is add, evict, update use_order,
-    version. 
-
-    expires
+    use_order -- an OrderedDict whose keys are the cache keys from
+    least to most recently used (the values are unused).  Touching,
+    evicting and finding the oldest entry are all O(1), which keeps
+    replaying a large LOG at startup linear in its length.
+
+    the log: writes every change to cache or use_order.  Unless
+    log_durability is 'sync', records are batched in memory and
+    written together once log_batch_records are pending, after
+    log_batch_delay msec, or when the cache is checkpointed or closed;
+    a crash loses at most the last batch.  With 'fsync' each batch is
+    also forced to disk.  The log is binary: a version line, then length-prefixed
+    records for add, evict and update use_order (see log_record).  It
+    is compacted into a snapshot every snapshot_interval records and
+    replayed through an mmap on startup.  Old text logs are migrated.
+
+    expires -- a min-heap of (expiry secs, key) pairs for pages with
+    an explicit expire date, with expire_index mapping each such key
+    to its entry.  Evicted keys are only dropped from the index; their
+    heap records are discarded lazily when they reach the top.
 
     evict
 
+    files -- cache files live two directory levels down, in a shard
+    derived from a hash of the key (see key_shard()); entries still in
+    the old flat layout are moved into their shards on open.
+
     Note: Nowhere do we verify that the disk has enough space for a
     full cache.
 
     """
 
-    def __init__(self, manager, size, directory):
+    def __init__(self, manager, size, directory, durability='batch'):
         self.max_size = size
         self.size = 0
         self.pref_dir = directory
@@ -610,85 +754,184 @@ class DiskCache:
         self.manager = manager
         self.manager.add_cache(self)
         self.items = {}
-        self.use_order = []
+        self.use_order = OrderedDict()
         self.log = None
+        self.log_durability = durability or 'batch'
+        self.log_pending = []
+        self.log_timer = None
         self.checkpoint = 0
+        self.log_records = 0
         self.expires = []
+        self.expire_index = {}
         self.types = {}
+        self.shard_dirs = {}
+        prefs = getattr(getattr(manager, 'app', None), 'prefs', None)
+        if prefs:
+            thumbnail_size = prefs.GetInt('disk-cache', 'thumbnail-size')
+        else:
+            thumbnail_size = 0
+        self.thumbnails = ThumbnailCache(
+            os.path.join(self.directory, 'thumbnails'), thumbnail_size * 1024)
 
         grailutil.establish_dir(self.directory)
         self._read_metadata()
+        self._migrate_flat_layout()
         self._reinit_log()
 
-    log_version = "1.3"
-    log_ok_versions = ["1.2", "1.3"]
+    log_version = "2.0"
+    log_ok_versions = ["1.2", "1.3", "2.0"]
+    # versions written as tab-separated text, migrated on first open
+    text_log_versions = ["1.2", "1.3"]
+    log_header = ('3 ' + log_version + '\n').encode('ascii')
+
+    # records appended to the log before it is compacted into a snapshot
+    snapshot_interval = 10000
+
+    # group commit: pending records that force a write, and the delay
+    # (msec) after which a partial batch is written anyway
+    log_batch_records = 64
+    log_batch_delay = 1000
 
     def close(self,log):
         self.manager.delete(self.items.keys(), evict=0)
+        if self.log:
+            self.flush_log()
         if log:
-            self.use_order = []
+            self.use_order = OrderedDict()
             self._checkpoint_metadata()
         del self.items
         del self.expires
+        del self.expire_index
         self.manager.close_cache(self)
         self.dead = 1
 
     def _read_metadata(self):
         """Read the transaction log from the cache directory.
 
-        Reads the pickled log entries and re-creates the cache's
-        current contents and use_order from the log.
-
-        A version number is included, but currently we only assert
-        that a the version number read is the same as the current
-        version number.
+        Re-creates the cache's current contents and use_order from the
+        log.  The log starts with a version record; logs written in one
+        of the old text formats are replayed by _read_text_metadata()
+        and then rewritten in the current binary format.  A binary log
+        that has grown well past the live entries is compacted into a
+        fresh snapshot.
         """
         logpath = os.path.join(self.directory, 'LOG')
         try:
-            log = open(logpath)
+            log = open(logpath, 'rb')
         except IOError:
             # now what happens if there is an error here?
-            log = open(logpath, 'w')
+            log = open(logpath, 'wb')
+            log.write(self.log_header)
             log.close()
             return
 
+        header = log.readline()
+        if header == self.log_header:
+            records = self._read_binary_metadata(log, logpath)
+            if records > 2 * len(self.items) + self.snapshot_interval:
+                self._checkpoint_metadata()
+            return
+
+        log.close()
+        if header:
+            log = open(logpath)
+            self._read_text_metadata(log)
+            log.close()
+        self._checkpoint_metadata()
+
+    def _read_binary_metadata(self, log, logpath):
+        """Replay a binary log through an mmap; return # of records.
+
+        Each record is a log_record header (kind, payload length)
+        followed by the payload: a packed DiskCacheEntry for adds, the
+        key for deletes and use-order updates.  A torn record at the
+        end, left by a crash mid-write, is truncated away.
+        """
+        import mmap
+        start = log.tell()
+        end = os.fstat(log.fileno())[6]
+        if end <= start:
+            log.close()
+            return 0
+        buf = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        items = self.items
+        manager_items = self.manager.items
+        use_order = self.use_order
+        hsize = log_record.size
+        offset = start
+        records = 0
+        try:
+            while offset + hsize <= end:
+                kind, length = log_record.unpack_from(buf, offset)
+                body = offset + hsize
+                if body + length > end:
+                    break
+                if kind == 2: # use update
+                    key = buf[body:body+length].decode('utf-8')
+                    if key in use_order:
+                        use_order.move_to_end(key)
+                elif kind == 1: # delete
+                    key = buf[body:body+length].decode('utf-8')
+                    if key in items:
+                        self.size = self.size - items[key].size
+                        del items[key]
+                        del manager_items[key]
+                        del use_order[key]
+                elif kind == 0: # add
+                    newentry = DiskCacheEntry(self)
+                    newentry.unpack(buf, body)
+                    if newentry.key not in items:
+                        use_order[newentry.key] = None
+                    items[newentry.key] = newentry
+                    manager_items[newentry.key] = newentry
+                    self.size = self.size + newentry.size
+                offset = body + length
+                records = records + 1
+        finally:
+            buf.close()
+            log.close()
+        if offset < end:
+            os.truncate(logpath, offset)
+        return records
+
+    def _read_text_metadata(self, log):
+        """Replay a log in one of the text_log_versions formats."""
         for line in log.readlines():
             try:
                 kind = line[0:1]        
                 if kind == '2': # use update
                     key = line[2:-1]
-                    self.use_order.remove(key)
-                    self.use_order.append(key)
+                    if key in self.use_order:
+                        self.use_order.move_to_end(key)
                 elif kind == '1':           # delete
                     key = line[2:-1]
                     if self.items.has_key(key):
                         self.size = self.size - self.items[key].size
                         del self.items[key]
                         del self.manager.items[key]
-                        self.use_order.remove(key)
-                        Assert(not key in self.use_order)
+                        del self.use_order[key]
                 elif kind == '0': # add
                     newentry = DiskCacheEntry(self)
                     newentry.parse(line[2:-1])
                     if not self.items.has_key(newentry.key):
-                        self.use_order.append(newentry.key)
+                        self.use_order[newentry.key] = None
                     newentry.cache = self
                     self.items[newentry.key] = newentry
                     self.manager.items[newentry.key] = newentry
                     self.size = self.size + newentry.size
                 elif kind == '3': # version (hopefully first)
                     ver = line[2:-1]
-                    if ver not in self.log_ok_versions:
+                    if ver not in self.text_log_versions:
                    ### clear out anything we might have read
                    ### and bail. this is an old log file.
                         if len(self.use_order) > 0:
-                            self.use_order = []
+                            self.use_order = OrderedDict()
                             for key in self.items.keys():
                                 del self.items[key]
                                 del self.manager.items[key]
                                 self.size = 0
                             return
-                    Assert(ver in self.log_ok_versions)
+                    Assert(ver in self.text_log_versions)
             except IndexError:
                 # ignore this line
                 pass
@@ -700,101 +943,188 @@ class DiskCache:
         cache.
         """
         import traceback
+        # the checkpoint records the current state, which already
+        # reflects anything still waiting to be logged
+        self.cancel_log_flush()
+        self.log_pending = []
         if self.log:
             self.log.close()
+            self.log = None
         try:
             newpath = os.path.join(self.directory, 'CHECKPOINT')
 
-            newlog = open(newpath, 'w')
-            newlog.write('3 ' + self.log_version + '\n')
+            newlog = open(newpath, 'wb')
+            newlog.write(self.log_header)
             for key in self.use_order:
                 self.log_entry(self.items[key],alt_log=newlog,flush=None)
                 # don't flush writes during the checkpoint, because if
                 # we crash it won't matter
             newlog.close()
             logpath = os.path.join(self.directory, 'LOG')
-            os.unlink(logpath)
+            if os.path.exists(logpath):
+                os.unlink(logpath)
             os.rename(newpath, logpath)
         except:
-            print "exception during checkpoint"
+            print("exception during checkpoint")
             traceback.print_exc()
+        self.log_records = 0
+
+    def _snapshot_metadata(self):
+        """Compact a long-running log into a fresh snapshot."""
+        self._checkpoint_metadata()
+        self._reinit_log()
 
     def _reinit_log(self):
         """Open the log for writing new transactions."""
         logpath = os.path.join(self.directory, 'LOG')
-        self.log = open(logpath, 'a')
+        self.log = open(logpath, 'ab')
 
     def log_entry(self,entry,delete=0,alt_log=None,flush=1):
         """Write to the log adds and evictions."""
-        if alt_log:
-            dest = alt_log
-        else:
-            dest = self.log
         if delete:
-            dest.write('1 ' + entry.key + '\n')
+            record = pack_log_record(1, entry.key.encode('utf-8'))
+        else:
+            record = pack_log_record(0, entry.pack())
+        if alt_log:
+            alt_log.write(record)
+            if flush:
+                alt_log.flush()
         else:
-            dest.write('0 ' + entry.unparse() + '\n')
-        if flush:
-            dest.flush()
+            self.log_write(record)
 
     def log_use_order(self,key):
         """Write to the log changes in use_order."""
         if self.items.has_key(key):
-            self.log.write('2 ' + key + '\n')
-            # should we flush() here? probably...
+            self.log_write(pack_log_record(2, key.encode('utf-8')))
+
+    def log_write(self, record):
+        """Append a record to the log according to log_durability."""
+        if self.log_durability == 'sync':
+            if self.log_pending:
+                # batched before the mode changed; keep the log in order
+                self.flush_log()
+            self.log.write(record)
             self.log.flush()
+        else:
+            self.log_pending.append(record)
+            if len(self.log_pending) >= self.log_batch_records:
+                self.flush_log()
+            elif self.log_timer is None:
+                self.schedule_log_flush()
+        self.log_written()
+
+    def flush_log(self):
+        """Write out the pending batch of log records."""
+        self.cancel_log_flush()
+        if not self.log:
+            # checkpointed and not reopened; the checkpoint holds it all
+            return
+        if self.log_pending:
+            self.log.write(b''.join(self.log_pending))
+            self.log_pending = []
+        self.log.flush()
+        if self.log_durability == 'fsync':
+            os.fsync(self.log.fileno())
+
+    def schedule_log_flush(self):
+        """Arrange for a partial batch to be written after a delay.
+
+        Without a Tk root (e.g. when the cache is used outside the
+        browser) batches are only written when full or on close.
+        """
+        app = getattr(self.manager, 'app', None)
+        root = getattr(app, 'root', None)
+        if root:
+            self.log_timer = (root, root.after(self.log_batch_delay,
+                                               self.log_timer_expired))
+
+    def log_timer_expired(self):
+        self.log_timer = None
+        if self.log:
+            self.flush_log()
+
+    def cancel_log_flush(self):
+        if self.log_timer:
+            root, id = self.log_timer
+            self.log_timer = None
+            root.after_cancel(id)
 
-    cache_file = regex.compile('^spam[0-9]+')
+    def log_written(self):
+        """Count a log record; snapshot once the log has grown large."""
+        self.log_records = self.log_records + 1
+        if self.log_records > self.snapshot_interval \
+           and self.log_records > 2 * len(self.items):
+            self._snapshot_metadata()
+
+    cache_file = re.compile('spam[0-9]+')
 
     def erase_cache(self):
+        """Erase every cache file and start over with an empty cache.
+
+        The cache is reset right away; the files are unlinked by
+        sweep_cache_files() on worker threads.  Returns the sweep's
+        futures.
+        """
 
         if hasattr(self,'dead'):
             # they got me
-            self.manager.disk.erase_cache()
-            return
-
-        def walk_erase(regexp,dir,files):
-            for file in files:
-                if regexp.match(file) != -1:
-                    path = os.path.join(dir,file)
-                    if os.path.isfile(path):
-                        os.unlink(path)
+            return self.manager.disk.erase_cache()
 
-        os.path.walk(self.directory, walk_erase, self.cache_file)
+        cutoff = time.time()
+        directory = self.directory
+        thumbnails = self.thumbnails
         self.manager.reset_disk_cache(flush_log=1)
+        return sweep_cache_files(directory, {}, cutoff, self.cache_file) \
+               + thumbnails.erase(cutoff)
 
     def erase_unlogged_files(self):
+        """Erase cache files that the log does not know about.
+
+        Runs on worker threads like erase_cache(); returns the futures.
+        """
 
         if hasattr(self,'dead'):
             # they got me
-            self.manager.disk.erase_unlogged_files()
-            return
-
-        def walk_erase_unknown(known,dir,files,regexp=self.cache_file):
-            for file in files:
-                if not known.has_key(file) \
-                   and regexp.match(file) != -1:
-                    path = os.path.join(dir,file)
-                    if os.path.isfile(path):
-                        os.unlink(path)
-
-        files = map(lambda entry:entry.file, self.items.values())
-        file_dict = { 'LOG': 1 }
-        for file in files:
-            file_dict[file] = 1
-        os.path.walk(self.directory, walk_erase_unknown, file_dict)
+            return self.manager.disk.erase_unlogged_files()
+
+        file_dict = {}
+        for entry in self.items.values():
+            file_dict[entry.file] = 1
+        return sweep_cache_files(self.directory, file_dict, time.time(),
+                                 self.cache_file)
+
+    def _migrate_flat_layout(self):
+        """Move files left in the old flat layout into their shards."""
+        moved = 0
+        for entry in self.items.values():
+            if '/' in entry.file:
+                continue
+            newfile = key_shard(entry.key) + '/' + entry.file
+            newpath = self.get_file_path(newfile)
+            dir = os.path.dirname(newpath)
+            if dir not in self.shard_dirs:
+                grailutil.establish_dir(dir)
+                self.shard_dirs[dir] = 1
+            try:
+                os.rename(self.get_file_path(entry.file), newpath)
+            except os.error:
+                # a missing file shows up as CacheReadFailed later
+                pass
+            entry.file = newfile
+            moved = 1
+        if moved:
+            self._checkpoint_metadata()
 
     def get(self,key):
         """Update and log use_order."""
         Assert(self.items.has_key(key))
-        self.use_order.remove(key)
-        self.use_order.append(key)
+        self.use_order.move_to_end(key)
         self.log_use_order(key)
 
     def update(self,object):
         # this is simple, but probably not that efficient
         self.evict(object.key)
-        self.add(object)
+        return self.add(object)
 
     def add(self,object):
         """Creates a DiskCacheEntry for object and adds it to cache.
@@ -820,11 +1150,11 @@ class DiskCache:
             self.add_expireable(newitem)
 
         self.make_file(newitem,object)
-        self.log_entry(newitem)
 
         self.items[object.key] = newitem
         self.manager.items[object.key] = newitem
-        self.use_order.append(object.key)
+        self.use_order[object.key] = None
+        self.log_entry(newitem)
 
         return newitem
 
@@ -864,13 +1194,26 @@ class DiskCache:
 
 
     def add_expireable(self,entry):
-        """Adds entry to list of pages with explicit expire date."""
-        self.expires.append(entry)
+        """Adds entry to the heap of pages with explicit expire date."""
+        self.expire_index[entry.key] = entry
+        heapq.heappush(self.expires, (entry.expires.get_secs(), entry.key))
+        if len(self.expires) > 2 * len(self.expire_index) + 64:
+            self._compact_expires()
+
+    def _compact_expires(self):
+        """Rebuild the expires heap without stale records."""
+        self.expires = [(entry.expires.get_secs(), key)
+                        for key, entry in self.expire_index.items()]
+        heapq.heapify(self.expires)
 
     def get_file_name(self,entry):
-        """Invent a filename for a new cache entry."""
+        """Invent a filename for a new cache entry.
+
+        The name is relative to the cache directory and includes the
+        entry's shard, so no single directory grows too large.
+        """
         filename = 'spam' + str(time.time()) + self.get_suffix(entry.type)
-        return filename
+        return key_shard(entry.key) + '/' + filename
 
     def get_file_path(self,filename):
         path = os.path.join(self.directory, filename)
@@ -885,6 +1228,10 @@ class DiskCache:
     def make_file(self,entry,object):
         """Write the object's data to disk."""
         path = self.get_file_path(entry.file)
+        dir = os.path.dirname(path)
+        if dir not in self.shard_dirs:
+            grailutil.establish_dir(dir)
+            self.shard_dirs[dir] = 1
         try:
             f = open(path, 'wb')
             f.writelines(object.data)
@@ -922,42 +1269,264 @@ class DiskCache:
         """Evict the least recently used page."""
         # get ride of least-recently used thing
         if len(self.items) > 0:
-            key = self.use_order[0]
+            key = next(iter(self.use_order))
             self.evict(key)
         else:
             raise CacheEmpty
 
     def evict_expired_pages(self):
-        """Evict any pages on the expires list that have expired."""
-        self.expires.sort(compare_expire_items)
-        size = len(self.expires)
-        if size > 0 \
-           and self.expires[0].expires.get_secs() < time.time():
-            index = 0
-            t = time.time()
-            while index < size and self.expires[index].expires.get_secs() < t:
-                index = index + 1
-            for item in self.expires[0:index]:
-                self.evict(item.key)
-            del self.expires[0:index]
+        """Evict any pages on the expires heap that have expired."""
+        t = time.time()
+        while self.expires and self.expires[0][0] < t:
+            secs, key = heapq.heappop(self.expires)
+            entry = self.expire_index.get(key)
+            if entry is None or entry.expires.get_secs() != secs:
+                # stale record for an evicted or replaced entry
+                continue
+            self.evict(key)
 
     def evict(self,key):
         """Remove an entry from the cache and delete the file from disk."""
-        self.use_order.remove(key)
+        del self.use_order[key]
         evictee = self.items[key]
         del self.manager.items[key]
         del self.items[key]
-        if key in self.expires:
-            self.expires.remove(key)
+        if key in self.expire_index:
+            del self.expire_index[key]
         try:
             os.unlink(self.get_file_path(evictee.file))
         except (os.error, IOError), err:
             # print "error deleteing %s from cache: %s" % (key, err)
             pass
+        self.thumbnails.discard(key)
         self.log_entry(evictee,1) # 1 indicates delete entry
         evictee.delete()
         self.size = self.size - evictee.size
 
+# directory -> ThumbnailCache, for write_thumbnail()
+thumbnail_caches = {}
+
+class ThumbnailCache:
+    """Decoded images derived from the entries of a DiskCache.
+
+    A thumbnail is the already scaled and background-composited
+    raster of a cached image, stored as a short header followed by
+    the zlib-compressed pixels, so a later visit can skip decoding.
+    Files are named for the source key, requested size and background
+    and live in key_shard() subdirectories of directory.
+
+    Each file records a validator taken from its source entry (the
+    entry's cache file name and size, which change whenever the
+    source is stored again); a thumbnail whose validator no longer
+    matches is ignored and overwritten.  Evicting the source removes
+    its thumbnails.
+
+    The files are kept within max_size bytes (no limit if 0): when a
+    write takes them over budget, the least recently used are removed
+    on a worker thread until they fit in low_water of it.
+    """
+
+    magic = b'GTHUMB 1\n'
+    thumb_file = re.compile('[0-9a-f]{32}-[0-9]+x[0-9]+-[0-9a-f]{6}')
+    low_water = 0.9
+
+    def __init__(self, directory, max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None                # bytes on disk, once measured
+        self.trimming = 0
+        self.lock = threading.Lock()
+        thumbnail_caches[directory] = self
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.written(0)
+
+    def written(self, nbytes):
+        """Account for a new thumbnail file; safe from any thread."""
+        self.lock.acquire()
+        try:
+            if self.size is not None:
+                self.size = self.size + nbytes
+            trim = self.max_size and not self.trimming \
+                   and (self.size is None or self.size > self.max_size)
+            if trim:
+                self.trimming = 1
+        finally:
+            self.lock.release()
+        if trim:
+            sweep_pool().submit(self.trim)
+
+    def trim(self):
+        """Remove the least recently used thumbnails until they fit."""
+        files = []
+        total = 0
+        for dirpath, dirnames, names in os.walk(self.directory):
+            for name in names:
+                if not self.thumb_file.match(name):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except os.error:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total = total + st.st_size
+        if total > self.max_size:
+            files.sort()
+            target = int(self.max_size * self.low_water)
+            for mtime, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except os.error:
+                    continue
+                total = total - size
+        self.lock.acquire()
+        try:
+            self.size = total
+            self.trimming = 0
+        finally:
+            self.lock.release()
+
+    def lookup(self, entry, width, height, background):
+        """Return (path, validator) for a thumbnail of entry."""
+        digest = hashlib.md5(entry.key.encode('utf-8')).hexdigest()
+        name = '%s-%dx%d-%02x%02x%02x' % ((digest, width or 0, height or 0)
+                                          + tuple(background))
+        path = os.path.join(self.directory, key_shard(entry.key), name)
+        validator = '%s %d' % (entry.file, entry.size)
+        return path, validator
+
+    def discard(self, key):
+        """Remove every thumbnail of key."""
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        dir = os.path.join(self.directory, key_shard(key))
+        try:
+            names = os.listdir(dir)
+        except os.error:
+            return
+        for name in names:
+            if name[:len(digest)] == digest:
+                try:
+                    os.unlink(os.path.join(dir, name))
+                except os.error:
+                    pass
+
+    def erase(self, cutoff):
+        """Remove all thumbnails on worker threads; returns futures."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sweep_cache_files(self.directory, {}, cutoff,
+                                 self.thumb_file)
+
+
+def read_thumbnail(path, validator):
+    """Read a thumbnail file written by write_thumbnail().
+
+    Returns a (mode, (width, height), pixel bytes) tuple, or None if
+    the file is missing, damaged or does not match validator.  Safe
+    to call from any thread.
+    """
+    try:
+        f = open(path, 'rb')
+        try:
+            if f.readline() != ThumbnailCache.magic:
+                return None
+            if f.readline().decode('utf-8').rstrip('\n') != validator:
+                return None
+            mode, width, height = f.readline().decode('ascii').split()
+            data = zlib.decompress(f.read())
+        finally:
+            f.close()
+        # the modification time orders thumbnails for trimming
+        os.utime(path, None)
+        return str(mode), (int(width), int(height)), data
+    except (IOError, os.error, ValueError, zlib.error):
+        return None
+
+def write_thumbnail(path, validator, mode, size, data):
+    """Store pixels as a thumbnail file; safe to call from any thread.
+
+    The file is written under a name unique to this thread and
+    renamed into place, so readers never see a partial thumbnail.
+    """
+    header = '%s\n%s %d %d\n' % (validator, mode, size[0], size[1])
+    temp = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        grailutil.establish_dir(os.path.dirname(path))
+        f = open(temp, 'wb')
+        try:
+            f.write(ThumbnailCache.magic)
+            f.write(header.encode('utf-8'))
+            f.write(zlib.compress(data, 1))
+            nbytes = f.tell()
+        finally:
+            f.close()
+        os.rename(temp, path)
+    except (IOError, os.error):
+        try:
+            os.unlink(temp)
+        except os.error:
+            pass
+        return
+    # thumbnails live in key_shard() subdirectories of their cache
+    directory = os.path.dirname(os.path.dirname(os.path.dirname(path)))
+    if directory in thumbnail_caches:
+        thumbnail_caches[directory].written(nbytes)
+
+
+_sweep_pool = None
+
+def sweep_pool():
+    """Return the worker pool for cache file maintenance."""
+    global _sweep_pool
+    if _sweep_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _sweep_pool = ThreadPoolExecutor(4)
+    return _sweep_pool
+
+def sweep_cache_files(directory, known, cutoff, regexp):
+    """Unlink cache files below directory that are not in known.
+
+    known maps file names relative to directory (with '/' separators)
+    to true values.  Only files last modified before cutoff are
+    removed, so files the cache writes while the sweep runs survive
+    it.  The top level and each shard run as separate tasks on a
+    shared thread pool so the Tk main loop is never blocked; returns
+    the list of futures.
+    """
+    pool = sweep_pool()
+    futures = [pool.submit(_sweep_dir, directory, '', known,
+                           cutoff, regexp, 0)]
+    for name in os.listdir(directory):
+        if os.path.isdir(os.path.join(directory, name)):
+            futures.append(pool.submit(_sweep_dir, directory,
+                                       name + '/', known, cutoff,
+                                       regexp, 1))
+    return futures
+
+def _sweep_dir(directory, prefix, known, cutoff, regexp, recurse):
+    """Sweep one directory (and its subdirectories if recurse)."""
+    count = 0
+    dir = os.path.join(directory, prefix)
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        if os.path.isdir(path):
+            if recurse:
+                count = count + _sweep_dir(directory, prefix + name + '/',
+                                           known, cutoff, regexp, 1)
+        elif regexp.match(name) and prefix + name not in known:
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    count = count + 1
+            except os.error:
+                pass
+    return count
+
+
 class disk_cache_access:
     """protocol access interface for disk cache"""
 
@@ -1015,6 +1584,108 @@ class disk_cache_access:
         """
         return self.filename, self.headers['content-type']
 
+class memory_cache_access(disk_cache_access):
+    """protocol access interface for objects held by a MemoryCache"""
+
+    def __init__(self, filename, data, content_type, date,
+                 content_encoding, transfer_encoding):
+        self.headers = { 'content-type' : content_type,
+                         'date' : date,
+                         'content-length' : str(len(data)) }
+        if content_encoding:
+            self.headers['content-encoding'] = content_encoding
+        if transfer_encoding:
+            self.headers['content-transfer-encoding'] = transfer_encoding
+        self.filename = filename
+        self.data = data
+        self.offset = 0
+        self.fp = None
+        self.state = DATA
+
+    def getdata(self,maxbytes):
+        data = self.data[self.offset:self.offset+maxbytes]
+        self.offset = self.offset + len(data)
+        if not data:
+            self.state = DONE
+        return data
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        self.data = None
+
+
+class MemoryCache:
+    """Bounded in-memory tier in front of the disk cache.
+
+    Holds the bytes of small objects (at most max_object bytes each,
+    max_size in total) so that frequently reused things like icons,
+    stylesheets and spacer images are served without touching the
+    disk.  Entries are kept in LRU order and evicted when the budget
+    is exceeded.  Each key is stored with the DiskCacheEntry it was
+    read from; if the disk cache has since replaced that entry, the
+    bytes are stale and are dropped on lookup.
+
+    hits, misses and evictions count lookups and LRU evictions.
+    """
+
+    def __init__(self, max_size, max_object):
+        self.max_size = max_size
+        self.max_object = max_object
+        self.size = 0
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, entry):
+        """Return the bytes cached for entry, or None."""
+        try:
+            owner, data = self.items[entry.key]
+        except KeyError:
+            self.misses = self.misses + 1
+            return None
+        if owner is not entry:
+            self.discard(entry.key)
+            self.misses = self.misses + 1
+            return None
+        self.items.move_to_end(entry.key)
+        self.hits = self.hits + 1
+        return data
+
+    def add(self, entry, data):
+        """Remember data as the contents of entry, if it fits."""
+        if len(data) > self.max_object or len(data) > self.max_size:
+            return
+        self.discard(entry.key)
+        self.items[entry.key] = (entry, data)
+        self.size = self.size + len(data)
+        self.shrink()
+
+    def discard(self, key):
+        if key in self.items:
+            entry, data = self.items.pop(key)
+            self.size = self.size - len(data)
+
+    def resize(self, max_size, max_object):
+        self.max_size = max_size
+        self.max_object = max_object
+        self.shrink()
+
+    def shrink(self):
+        """Evict least recently used objects until within budget."""
+        while self.size > self.max_size:
+            key, (entry, data) = self.items.popitem(last=False)
+            self.size = self.size - len(data)
+            self.evictions = self.evictions + 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'objects': len(self.items),
+                'bytes': self.size}
+
+
 class HTTime:
     """Stores time as HTTP string or seconds since epoch or both.
 
@@ -1062,3 +1733,87 @@ class HTTime:
             return self.str
         else:
             return str(None)
+
+
+class _BenchManager:
+    """Minimal stand-in for CacheManager, used by benchmark()."""
+
+    def __init__(self):
+        self.items = {}
+        self.caches = []
+
+    def add_cache(self, cache):
+        self.caches.append(cache)
+
+    def close_cache(self, cache):
+        self.caches.remove(cache)
+
+    def delete(self, keys, evict=1):
+        for key in keys:
+            if key in self.items:
+                del self.items[key]
+
+
+def benchmark(n=100000):
+    """Replay a synthetic n-entry LOG and time the LRU bookkeeping.
+
+    The log holds n adds, n/2 use-order updates and n/10 deletes, which
+    is roughly what a large, long-lived cache directory looks like.  It
+    is written in the old text format, so the first open also times
+    the migration; the second open replays the binary log.
+    """
+    import random
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        now = time.time()
+        log = open(os.path.join(directory, 'LOG'), 'w')
+        log.write('3 1.3\n')
+        keys = []
+        for i in range(n):
+            key = 'http://bench.example/obj%d' % i
+            keys.append(key)
+            log.write('0 %s\t%s\t%s/spam%d\t%d\t%s\t%s\tNone\t'
+                      'image/gif\tNone\tNone\n'
+                      % (key, key, key_shard(key), i, 100, now, now))
+        for i in range(n // 2):
+            log.write('2 ' + random.choice(keys) + '\n')
+        for key in random.sample(keys, n // 10):
+            log.write('1 ' + key + '\n')
+        log.close()
+
+        manager = _BenchManager()
+        t0 = time.time()
+        cache = DiskCache(manager, 100 * n, directory)
+        t1 = time.time()
+        print("migrated %d text log records in %.3f sec"
+              % (n + n // 2 + n // 10, t1 - t0))
+        cache.log.close()
+
+        manager = _BenchManager()
+        t0 = time.time()
+        cache = DiskCache(manager, 100 * n, directory)
+        t1 = time.time()
+        print("opened %d entry binary log in %.3f sec"
+              % (len(cache.items), t1 - t0))
+
+        live = list(cache.items.keys())
+        t0 = time.time()
+        for i in range(n):
+            cache.get(random.choice(live))
+        t1 = time.time()
+        print("%d touches in %.3f sec" % (n, t1 - t0))
+
+        t0 = time.time()
+        cache.max_size = 0
+        cache.make_space(0)
+        t1 = time.time()
+        print("evicted %d entries in %.3f sec" % (len(live), t1 - t0))
+        cache.log.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -233,7 +233,7 @@ class Context(URIContext):
                         maxbytes = maxbytes + reader.maxbytes
                     else:
                         maxbytes = -1
-                    if reader.api.iscached():
+                    if reader.api and reader.api.iscached():
                         cached = cached + 1
                 if maxbytes > 0:
                     percent = nbytes*100/maxbytes
@@ -288,7 +288,7 @@ class Context(URIContext):
         if not self.app.load_images: return None
 
         # try loading from the cache
-        image = self.app.get_cached_image((url, width, height))
+        image = self.app.get_cached_image((url, width, height), self.viewer)
         if image and (not reload or image.is_reloading()):
             if not image.loaded:
                 image.start_loading(self)
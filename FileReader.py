@@ -1,5 +1,6 @@
 """File reader class -- read from a URL to a file in the background."""
 
+import string
 from BaseReader import BaseReader
 
 class FileReader(BaseReader):
@@ -54,7 +55,10 @@ class TempFileReader(FileReader):
 
     """Derived class of FileReader that chooses a temporary file.
 
-    This also supports inserting a filtering pipeline.
+    This also supports inserting a filtering pipeline.  Data sent with
+    a content-encoding Reader knows how to decode (gzip, deflate,
+    compress) is decoded in process as it arrives, before it reaches
+    the file or the pipeline.
     """
 
     def __init__(self, context, api):
@@ -73,12 +77,19 @@ class TempFileReader(FileReader):
 
     def open_file(self):
         if not self.pipeline:
-            return FileReader.open_file(self)
+            fp = FileReader.open_file(self)
         else:
             import os, sys
             if not hasattr(os, 'popen'):
                 raise IOError, "pipelines not supported"
             try:
-                return os.popen(self.pipeline + ">" + self.filename, "wb")
+                fp = os.popen(self.pipeline + ">" + self.filename, "wb")
             except os.error, msg:
                 raise IOError, msg, sys.exc_traceback
+        encoding = getattr(self, 'content_encoding', None)
+        if encoding:
+            import Reader
+            encoding = string.lower(encoding)
+            if Reader.content_decoding_wrappers.has_key(encoding):
+                fp = Reader.DecodingWriter(fp, encoding)
+        return fp
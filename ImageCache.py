@@ -1,23 +1,59 @@
+from collections import OrderedDict
+from Tkinter import TclError
+
+
+# Tk keeps the pixels of a photo image as 32-bit RGBA blocks
+BANDS = 4
+
+
+def image_bytes(image):
+    """Return the decoded size of a Tk/PIL image in bytes."""
+    try:
+        return image.width() * image.height() * BANDS
+    except (TclError, AttributeError):
+        return 0
+
+
 class ImageCache:
-    
+
     """a cache for Tk image objects and their python wrappers
 
-    The current goal of this cache is to provide a safe mechanism for
-    sharing image objects between multiple Viewer windows.
+    The cache provides a safe mechanism for sharing image objects
+    between multiple Viewer windows, and keeps the decoded pixels of
+    the images it holds within a byte budget.
 
-    In future release, the image cache should actually delete objects
-    from the cache (what a concept!). Currently, a Grail process will
-    grow without bound as new images are displayed. This is a bug.
+    Each image is owned by the Viewers currently displaying it.  A
+    Viewer gives up its images when it is reset for a new page or
+    closed (see owner_reset() and owner_exiting()); only images no
+    Viewer owns are evicted, least recently used first.  The budget
+    is soft: owned images are never evicted, so it may be exceeded
+    while they are on display.
+
+    Old copies of an image, kept for the Viewers still showing it
+    after a reload replaced it, are held in old_objects and released
+    with their owner.
     """
 
-    def __init__(self, url_cache):
+    def __init__(self, url_cache, max_size=32*1024*1024):
         self.image_objects = {}
         self.old_objects = {}
         self.current_owners = {}
         self.url_cache = url_cache
+        self.max_size = max_size
+        self.size = 0                   # bytes in image_objects/old_objects
+        self.sizes = {}                 # key -> bytes
+        self.keys = {}                  # id(image) -> key
+        self.use_order = OrderedDict()  # keys, least recently used first
+        self.owned = {}                 # owner -> {key: 1}
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.released = 0
 
     def debug_show_state(self):
         print "debugging ouput\ncurrent state of image cache"
+        print "%d bytes of %d, %d evictions (%d bytes)" \
+              % (self.size, self.max_size, self.evictions,
+                 self.evicted_bytes)
         for image in self.image_objects.keys():
             print "Image: %s.\n  Owners=%s" % (image,
                                             self.current_owners[image])
@@ -33,34 +69,125 @@ class ImageCache:
                     (height or 0))
         return None
 
-    def get_image(self, key):
+    def get_image(self, key, owner=None):
         key = self.form_key(key)
         if key:
             if self.image_objects.has_key(key):
                 self.url_cache.touch(key=key)
+                del self.use_order[key]
+                self.use_order[key] = None
+                if owner is not None:
+                    self.add_owner(key, owner)
                 return self.image_objects[key]
         return None
 
     def set_image(self, key, image, owner):
         key = self.form_key(key)
+        owners = []
         if self.image_objects.has_key(key):
-            if owner not in self.current_owners[key] \
-               or len(self.current_owners[key]) > 1:
+            old = self.image_objects[key]
+            if old is image:
+                owners = self.current_owners[key]
+            else:
                 for other_owner in self.current_owners[key]:
                     if other_owner != owner:
-                        self.keep_old_copy(other_owner, image, key)
+                        self.keep_old_copy(other_owner, old, key)
             if self.old_objects.has_key(owner):
-                for pair in self.old_objects[owner]:
+                for pair in self.old_objects[owner][:]:
                     if pair[0] == key:
-                        self.old_objects[owner].remove(pair)
+                        self.drop_old_copy(owner, pair)
+            self.remove(key)
         self.image_objects[key] = image
-        self.current_owners[key] = [owner]
+        self.keys[id(image)] = key
+        self.sizes[key] = image_bytes(image)
+        self.size = self.size + self.sizes[key]
+        self.use_order[key] = None
+        self.current_owners[key] = owners
+        if owner is not None:
+            self.add_owner(key, owner)
+        self.shrink()
+
+    def image_resized(self, image):
+        """Account for an image whose pixels were (re)loaded."""
+        key = self.keys.get(id(image))
+        if key is None or self.image_objects.get(key) is not image:
+            return
+        size = image_bytes(image)
+        self.size = self.size + size - self.sizes[key]
+        self.sizes[key] = size
+        self.shrink()
 
     def keep_old_copy(self, owner, image, key):
-        key = self.form_key(key)
         if not self.old_objects.has_key(owner):
             self.old_objects[owner] = []
-        self.old_objects[owner].append((key,image))
+        size = image_bytes(image)
+        self.old_objects[owner].append((key, image, size))
+        self.size = self.size + size
+
+    def drop_old_copy(self, owner, pair):
+        self.old_objects[owner].remove(pair)
+        self.size = self.size - pair[2]
+        self.released = self.released + 1
+        if not self.old_objects[owner]:
+            del self.old_objects[owner]
+
+    def add_owner(self, key, owner):
+        owners = self.current_owners[key]
+        if owner not in owners:
+            owners.append(owner)
+        if not self.owned.has_key(owner):
+            self.owned[owner] = {}
+        self.owned[owner][key] = 1
+
+    def owner_reset(self, owner):
+        """Release everything owner holds; its page is going away."""
+        if self.owned.has_key(owner):
+            for key in self.owned[owner].keys():
+                if self.current_owners.has_key(key):
+                    owners = self.current_owners[key]
+                    if owner in owners:
+                        owners.remove(owner)
+            del self.owned[owner]
+        if self.old_objects.has_key(owner):
+            for pair in self.old_objects[owner][:]:
+                self.drop_old_copy(owner, pair)
+        self.shrink()
 
     def owner_exiting(self, owner):
-        del self.old_objects[owner]
+        self.owner_reset(owner)
+
+    def remove(self, key):
+        image = self.image_objects[key]
+        del self.image_objects[key]
+        del self.keys[id(image)]
+        del self.current_owners[key]
+        del self.use_order[key]
+        self.size = self.size - self.sizes[key]
+        del self.sizes[key]
+
+    def shrink(self):
+        """Evict unowned images, oldest first, until within budget."""
+        if self.size <= self.max_size:
+            return
+        for key in list(self.use_order.keys()):
+            if self.size <= self.max_size:
+                break
+            if self.current_owners[key]:
+                continue
+            self.evictions = self.evictions + 1
+            self.evicted_bytes = self.evicted_bytes + self.sizes[key]
+            self.remove(key)
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.shrink()
+
+    def stats(self):
+        """Return a dictionary of size and eviction counters."""
+        return {'size': self.size, 'max-size': self.max_size,
+                'images': len(self.image_objects),
+                'old-images': reduce(lambda n, l: n + len(l),
+                                     self.old_objects.values(), 0),
+                'evictions': self.evictions,
+                'evicted-bytes': self.evicted_bytes,
+                'released': self.released}
@@ -168,6 +168,7 @@ class Viewer(formatter.AbstractWriter):
         self.spacingtag = None          # Tag specifying spacing
         self.addtags = ()               # Additional tags (e.g. anchors)
         self.align = None               # Alignment setting
+        self.flowingtags = ()           # Tags for pendingdata
         self.pendingdata = ''           # Data 'on hold'
         self.targets = {}               # Mark names for anchors/footnotes
         self.new_tags()
@@ -392,6 +393,8 @@ class Viewer(formatter.AbstractWriter):
 
     def clear_reset(self):
         self._atemp = []
+        if self.context:
+            self.context.app.image_cache.owner_reset(self)
         for func in self.reset_interests[:]:
             func(self)
         # XXX Eventually the following code should be done using interests too
@@ -487,13 +490,17 @@ class Viewer(formatter.AbstractWriter):
         self.text.tk.call('tkScrollByUnits', self.text.vbar, 'v', -1)
 
     def new_tags(self, doit_now = 0):
-        if self.pendingdata and strip(self.pendingdata):
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
-        self.flowingtags = filter(
+        tags = filter(
             None,
             (self.align, self.fonttag, self.margintag, self.rightmargintag,
              self.spacingtag) + self.addtags)
+        if tags == self.flowingtags and not doit_now:
+            # Keep collecting flowing data for a single insert
+            return
+        if self.pendingdata and strip(self.pendingdata):
+            self.text.insert(END, self.pendingdata, self.flowingtags)
+            self.pendingdata = ''
+        self.flowingtags = tags
 
     # AbstractWriter methods
 
@@ -548,15 +555,15 @@ class Viewer(formatter.AbstractWriter):
     def new_styles(self, styles):
 ##      print 'New styles:', styles
         self.addtags = styles
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
         self.rightmarginlevel = rl = map(None, styles).count('blockquote')
         self.rightmargintag = rl and ('rightmargin_%d' % rl) or None
-        self.flowingtags = filter(
+        tags = filter(
             None,
             (self.align, self.fonttag, self.margintag, self.rightmargintag,
              self.spacingtag) + styles)
+        if tags != self.flowingtags:
+            self.flush()
+            self.flowingtags = tags
 
     def send_paragraph(self, blankline):
         self.pendingdata = self.pendingdata + ('\n' * blankline)
@@ -822,10 +829,12 @@ class Viewer(formatter.AbstractWriter):
         else:
             align = self.align
         prev_align, self.align = self.align, align
-        self.new_tags()
+        # the caller takes the insertion point from the widget, so the
+        # text before it and the leader must be there, not pending
+        self.new_tags(1)
         self.pendingdata = self.pendingdata + MIN_IMAGE_LEADER
         self.align = prev_align
-        self.new_tags()
+        self.new_tags(1)
 
     def add_subwindow(self, window, align=CENTER, index=END):
         if self.pendingdata:
@@ -32,6 +32,7 @@ import getopt
 import urllib
 import tempfile
 import posixpath
+import time
 
 # More imports
 import filetypes
@@ -230,53 +231,76 @@ class URLReadWrapper:
         if api:
             api.close()
 
+# Request classes for SocketQueue, most urgent first
+PRIORITIES = ('document', 'frame', 'image', 'prefetch')
+
+
 class SocketQueue:
     """A queue for managing a pool of sockets.
 
-    This class provides a mechanism to limit the number of concurrent open
-    sockets. Requests for sockets are queued if the maximum number of sockets
-    is already open.
+    This class limits the number of concurrent open sockets, both in
+    total and per host.  Requests for sockets are queued when no slot
+    is available and granted by priority class (see PRIORITIES), first
+    come first served within a class, skipping requests whose host is
+    already at its limit.  A requestor that returns its socket while
+    still queued -- e.g. because its Context was stopped -- is simply
+    dropped from the queue.
 
     Attributes:
         max: The maximum number of open sockets allowed.
-        blocked: A list of requestors waiting for a socket.
-        callbacks: A dictionary mapping requestors to their callbacks.
+        max_per_host: The maximum number of open sockets per host.
+        waiting: For each priority class, a list of [requestor,
+            callback, host, time queued] entries.
+        queued: A dictionary mapping waiting requestors to their entries.
+        active: A dictionary mapping requestors holding a socket to
+            their host.
         open: The number of currently open sockets.
+        host_open: A dictionary mapping hosts to their open sockets.
+        granted: The number of requests granted a socket so far.
+        total_wait: The total time (seconds) granted requests waited.
+        max_wait: The longest time (seconds) a request waited.
     """
 
-    def __init__(self, max_sockets):
+    def __init__(self, max_sockets, max_per_host=None):
         """Initializes the SocketQueue.
 
         Args:
             max_sockets: The maximum number of sockets that can be open at
                 once.
+            max_per_host: The maximum number of sockets that can be open
+                to one host at once; defaults to max_sockets.
         """
         self.max = max_sockets
-        self.blocked = []
-        self.callbacks = {}
+        self.max_per_host = max_per_host or max_sockets
+        self.waiting = {}
+        for priority in PRIORITIES:
+            self.waiting[priority] = []
+        self.queued = {}
+        self.active = {}
         self.open = 0
+        self.host_open = {}
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
 
-    def change_max(self, new_max):
+    def change_max(self, new_max, new_max_per_host=None):
         """Changes the maximum number of allowed open sockets.
 
-        If the new maximum is greater than the old one, this method will
+        If the new limits are higher than the old ones, this method will
         execute pending callbacks for blocked requests.
 
         Args:
             new_max: The new maximum number of open sockets.
+            new_max_per_host: The new maximum number of open sockets
+                per host.
         """
-        old_max = self.max
         self.max = new_max
-        if old_max < new_max and len(self.blocked) > 0:
-            for i in range(0,min(new_max-old_max, len(self.blocked))):
-                # run wild free sockets
-                self.open = self.open + 1
-                self.callbacks[self.blocked[0]]()
-                del self.callbacks[self.blocked[0]]
-                del self.blocked[0]
-            
-
-    def request_socket(self, requestor, callback):
+        if new_max_per_host:
+            self.max_per_host = new_max_per_host
+        self.dispatch()
+
+    def request_socket(self, requestor, callback, host=None,
+                       priority='document'):
         """Requests a socket from the queue.
 
         If a socket is available, the callback is executed immediately.
@@ -285,33 +309,89 @@ class SocketQueue:
         Args:
             requestor: The object requesting the socket.
             callback: The function to call when a socket is available.
+            host: The host the socket will connect to, for the per-host
+                limit.
+            priority: One of PRIORITIES.
         """
-        if self.open >= self.max:
-            self.blocked.append(requestor)
-            self.callbacks[requestor] = callback
-        else:
-            self.open = self.open + 1
-            callback()
+        if priority not in self.waiting:
+            priority = 'document'
+        entry = [requestor, callback, host, time.time()]
+        self.waiting[priority].append(entry)
+        self.queued[requestor] = entry
+        self.dispatch()
 
     def return_socket(self, owner):
         """Returns a socket to the queue, making it available for others.
 
         If there are blocked requests, this method will execute the callback
-        for the next request in the queue.
+        for the next one that may run.
 
         Args:
             owner: The object that is returning the socket.
         """
-        if owner in self.blocked:
+        if owner in self.queued:
             # died before its time
-            self.blocked.remove(owner)
-            del self.callbacks[owner]
-        elif len(self.blocked) > 0:
-            self.callbacks[self.blocked[0]]()  # apply callback
-            del self.callbacks[self.blocked[0]]
-            del self.blocked[0]
+            entry = self.queued[owner]
+            del self.queued[owner]
+            for entries in self.waiting.values():
+                if entry in entries:
+                    entries.remove(entry)
+                    break
+            return
+        if owner not in self.active:
+            return
+        host = self.active[owner]
+        del self.active[owner]
+        self.open = self.open - 1
+        self.host_open[host] = self.host_open[host] - 1
+        if not self.host_open[host]:
+            del self.host_open[host]
+        self.dispatch()
+
+    def dispatch(self):
+        """Grant sockets to waiting requests while slots are free."""
+        while self.open < self.max:
+            entry = self.next_request()
+            if not entry:
+                break
+            self.grant(entry)
+
+    def next_request(self):
+        """Remove and return the next request that may run, or None."""
+        for priority in PRIORITIES:
+            entries = self.waiting[priority]
+            for i in range(len(entries)):
+                host = entries[i][2]
+                if self.host_open.get(host, 0) < self.max_per_host:
+                    entry = entries[i]
+                    del entries[i]
+                    del self.queued[entry[0]]
+                    return entry
+        return None
+
+    def grant(self, entry):
+        requestor, callback, host, queued = entry
+        wait = time.time() - queued
+        self.granted = self.granted + 1
+        self.total_wait = self.total_wait + wait
+        self.max_wait = max(self.max_wait, wait)
+        self.open = self.open + 1
+        self.host_open[host] = self.host_open.get(host, 0) + 1
+        self.active[requestor] = host
+        callback()
+
+    def stats(self):
+        """Returns queue depth and wait-time metrics as a dictionary."""
+        depth = {}
+        for priority in PRIORITIES:
+            depth[priority] = len(self.waiting[priority])
+        if self.granted:
+            mean_wait = self.total_wait / self.granted
         else:
-            self.open = self.open - 1
+            mean_wait = 0.0
+        return {'open': self.open, 'queued': len(self.queued),
+                'depth': depth, 'granted': self.granted,
+                'mean-wait': mean_wait, 'max-wait': self.max_wait}
 
 class Application(BaseApplication.BaseApplication):
     """The main application class for the Grail browser.
@@ -360,12 +440,15 @@ class Application(BaseApplication.BaseApplication):
 
         # socket management
         sockets = self.prefs.GetInt('sockets', 'number')
-        self.sq = SocketQueue(sockets)
+        self.sq = SocketQueue(sockets,
+                              self.prefs.GetInt('sockets', 'per-host'))
         self.prefs.AddGroupCallback('sockets',
                                     lambda self=self: \
                                     self.sq.change_max(
                                         self.prefs.GetInt('sockets',
-                                                          'number')))
+                                                          'number'),
+                                        self.prefs.GetInt('sockets',
+                                                          'per-host')))
 
         # initialize on_exit_methods before global_history
         self.on_exit_methods = []
@@ -373,7 +456,13 @@ class Application(BaseApplication.BaseApplication):
         self.login_cache = {}
         self.rexec_cache = {}
         self.url_cache = CacheManager(self)
-        self.image_cache = ImageCache(self.url_cache)
+        self.image_cache = ImageCache(
+            self.url_cache, self.prefs.GetInt('image-cache', 'size') * 1024)
+        self.prefs.AddGroupCallback('image-cache',
+                                    lambda self=self: \
+                                    self.image_cache.resize(
+                                        self.prefs.GetInt('image-cache',
+                                                          'size') * 1024))
         self.auth = AuthenticationManager(self)
         self.root.report_callback_exception = self.report_callback_exception
         if sys.stdin.isatty():
@@ -470,16 +559,17 @@ class Application(BaseApplication.BaseApplication):
         # interrupts get through
         self.root.tk.createtimerhandler(KEEPALIVE_TIMER, self.keep_alive)
 
-    def get_cached_image(self, url):
+    def get_cached_image(self, url, owner=None):
         """Retrieves a cached image.
 
         Args:
             url: The URL of the image to retrieve.
+            owner: The Viewer that will display the image, if any.
 
         Returns:
             The cached image object, or None if not found.
         """
-        return self.image_cache.get_image(url)
+        return self.image_cache.get_image(url, owner)
 
     def set_cached_image(self, url, image, owner=None):
         """Caches an image.
@@ -537,7 +627,8 @@ class Application(BaseApplication.BaseApplication):
     def decode_pipeline(self, fp, content_encoding, error=1):
         """Decodes a file-like object with the given content encoding.
 
-        This method uses external programs (like gzip) to decode the data.
+        Decoding happens in process, chunk by chunk, as the returned
+        object is read (see Reader.DecodingFile).
 
         Args:
             fp: The file-like object to decode.
@@ -549,41 +640,14 @@ class Application(BaseApplication.BaseApplication):
             A new file-like object containing the decoded data, or None if
             the encoding is not supported and `error` is false.
         """
-        if content_encoding in self.decode_prog:
-            prog = self.decode_prog[content_encoding]
-            if not prog: return fp
-            tfn = tempfile.mktemp()
-            ok = 0
-            try:
-                temp = open(tfn, 'w')
-                BUFSIZE = 8192
-                while 1:
-                        buf = fp.read(BUFSIZE)
-                        if not buf: break
-                        temp.write(buf)
-                temp.close()
-                ok = 1
-            finally:
-                if not ok:
-                    try:
-                        os.unlink(tfn)
-                    except os.error:
-                        pass
-            pipeline = '%s <%s; rm -f %s' % (prog, tfn, tfn)
-            # XXX What if prog fails?
-            return os.popen(pipeline, 'r')
+        import Reader
+        if content_encoding in Reader.content_decoding_wrappers:
+            return Reader.DecodingFile(fp, content_encoding)
         if error:
             self.error_dialog(IOError,
                 "Can't decode content-encoding: %s" % content_encoding)
         return None
 
-    decode_prog = {
-        'gzip': 'gzip -d',
-        'x-gzip': 'gzip -d',
-        'compress': 'compress -d',
-        'x-compress': 'compress -d',
-        }
-
     def exception_dialog(self, message="", root=None):
         """Displays a dialog for the current exception.
 
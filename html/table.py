@@ -778,6 +778,10 @@ class Table(AttrElem):
 
     def _force_resize(self):
         # called when the stylesheet changes:
+        for cell in self._cells():
+            cell.changed()
+        if self.caption:
+            self.caption.changed()
         self._autolayout_2()
         self._autolayout_3(force=1)
 
@@ -786,15 +790,14 @@ class Table(AttrElem):
         # context have finished.  this typically occurs when there are
         # images inside table cells.  it will also happen for every
         # table cell exactly once, but if there are no embedded
-        # images, the actual resize will be inhibited.
+        # images, the actual resize will be inhibited.  embedded
+        # windows only report their new geometry once Tk has processed
+        # the pending idle tasks, so do that once for all cells.
+        self.container.update_idletasks()
         recalc_needed = None
-        for row in range(self._rowcount):
-            for col in range(self._colcount):
-                cell = self._table[(row, col)]
-                if cell in [EMPTY, OCCUPIED]:
-                    continue
-                status = cell.recalc()
-                recalc_needed = recalc_needed or status
+        for cell in self._cells():
+            status = cell.recalc()
+            recalc_needed = recalc_needed or status
         if recalc_needed:
             self._autolayout_2()
             self._autolayout_3(force=1)
@@ -802,6 +805,16 @@ class Table(AttrElem):
             self._map()
 
 
+    def _cells(self):
+        cells = []
+        for row in range(self._rowcount):
+            for col in range(self._colcount):
+                cell = self._table[(row, col)]
+                if cell not in (EMPTY, OCCUPIED):
+                    cells.append(cell)
+        return cells
+
+
 class ColumnarElem(AttrElem):
     # base class for COL, COLGROUP
     def __init__(self, attrs):
@@ -949,6 +962,13 @@ class ContainedText(AttrElem):
         self._tw.config(highlightthickness=0)
         self._width = 0
         self._embedheight = 0
+        # Layout cache: heights by width, valid until the content
+        # changes, and the geometry last given to the canvas, so
+        # unchanged cells cost no Tk calls on relayout.
+        self._heights = {}
+        self._subgeometry = []
+        self._x = self._y = 0
+        self._cwidth = self._cheight = None
 
     def new_formatter(self):
         formatter = AbstractFormatter(self._viewer)
@@ -967,20 +987,41 @@ class ContainedText(AttrElem):
         return self._minwidth           # likewise
 
     def height(self):
-        return max(self._embedheight, _get_height(self._tw))
+        width = self._cwidth
+        if not self._heights.has_key(width):
+            self._heights[width] = max(self._embedheight,
+                                       _get_height(self._tw))
+        return self._heights[width]
+
+    def changed(self):
+        # the content or its style changed; forget cached heights
+        self._heights = {}
 
     def recalc(self):
         # recalculate width and height upon notification of completion
-        # of all context's readers (usually image readers)
+        # of all context's readers (usually image readers).  returns
+        # true if the geometry of the embedded windows changed since
+        # the last call.  the readers may have changed the text itself,
+        # so the cached heights are dropped either way.
+        self.changed()
+        subgeometry = []
+        for sub in self._viewer.subwindows:
+            if hasattr(sub, 'table_geometry'):
+                subgeometry.append(sub.table_geometry())
+            else:
+                subgeometry.append(sub.winfo_geometry())
+        if subgeometry == self._subgeometry:
+            return 0
+        self._subgeometry = subgeometry
         min_nonaligned = self._minwidth
         maxwidth = self._maxwidth
         embedheight = self._embedheight
         # take into account all embedded windows
-        for sub in self._viewer.subwindows:
+        for geom in subgeometry:
             # the standard interface is used if the object has a
             # table_geometry() method
-            if hasattr(sub, 'table_geometry'):
-                submin, submax, height = sub.table_geometry()
+            if type(geom) is TupleType:
+                submin, submax, height = geom
                 min_nonaligned = max(min_nonaligned, submin)
                 maxwidth = max(maxwidth, submax)
                 embedheight = max(embedheight, height)
@@ -988,7 +1029,6 @@ class ContainedText(AttrElem):
                 # this is the best we can do
 ##              print 'non-conformant embedded window:', sub.__class__
 ##              print 'using generic method, which may be incorrect'
-                geom = sub.winfo_geometry()
                 if CELLGEOM_RE.search(geom) >= 0:
                     [w, h, x, y] = map(grailutil.conv_integer,
                                        CELLGEOM_RE.group(1, 2, 3, 4))
@@ -998,7 +1038,7 @@ class ContainedText(AttrElem):
         self._embedheight = embedheight
         self._minwidth = min_nonaligned
         self._maxwidth = maxwidth
-        return len(self._viewer.subwindows)
+        return len(subgeometry)
 
     def finish(self, padding=0):
         # TBD: if self.layout == AUTOLAYOUT???
@@ -1033,21 +1073,37 @@ class ContainedText(AttrElem):
             window=fw, anchor=NW,
             width=self._maxwidth,
             height=fw['height'])
+        self._cwidth = self._maxwidth
+        self._cheight = None
+        self.changed()
 
-    def situate(self, x=0, y=0, width=None, height=None):
+    def situate(self, x=None, y=None, width=None, height=None):
         # canvas.move() deals in relative positioning, but we want
-        # absolute coordinates
+        # absolute coordinates.  only changes are passed on to Tk, so
+        # a cell whose geometry is unchanged is not resized (nor are
+        # any tables nested in it).
+        if x is None: x = self._x
+        if y is None: y = self._y
         xdelta = x - self._x
         ydelta = y - self._y
         self._x = x
         self._y = y
-        self._container.move(self._tag, xdelta, ydelta)
+        if xdelta or ydelta:
+            self._container.move(self._tag, xdelta, ydelta)
+        if width == self._cwidth:
+            width = None
+        elif width <> None:
+            self._cwidth = width
+        if height == self._cheight:
+            height = None
+        elif height <> None:
+            self._cheight = height
         if width <> None and height <> None:
             self._container.itemconfigure(self._tag,
                                           width=width, height=height)
         elif width <> None:
             self._container.itemconfigure(self._tag, width=width)
-        else:
+        elif height <> None:
             self._container.itemconfigure(self._tag, height=height)
 
 
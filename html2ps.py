@@ -42,5 +42,8 @@ if __name__ == '__main__':
     if sys.argv[1:] and sys.argv[1] == "--profile":
         del sys.argv[1]
         printing.main.profile_main()
+    elif sys.argv[1:] and sys.argv[1] == "--benchmark":
+        del sys.argv[1]
+        printing.main.benchmark_main()
     else:
         printing.main.main()
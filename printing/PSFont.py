@@ -76,6 +76,7 @@ class PSFont:
        __init__(optional: VARIFAMILY, FIXEDFAMILY)
        set_font((SIZE, ITALIC?, BOLD?, TT?)) ==> (PSFONTNAME, SIZE)
        text_width(TEXT) ==> WIDTH_IN_POINTS
+       word_offsets(WORDS) ==> (STARTS, ENDS)
        font_size(optional: (SIZE, ITALIC?, BOLD?, TT?)) ==> SZ_IN_POINTS
     """
     def __init__(self, varifamily='Times', fixedfamily='Courier',
@@ -130,6 +131,7 @@ class PSFont:
             }
         # instantiated font objects
         self.fontobjs = {}
+        self.fontobj = None
         self.tw_func = None
 
     def get_font(self):
@@ -179,7 +181,8 @@ class PSFont:
             psfontname = self.docfonts[fontnickname]
             self.fontobjs[fontnickname] = fonts.font_from_name(psfontname)
 ##      print fontnickname, "==>", self.fontobjs[fontnickname]
-        self.tw_func = self.fontobjs[fontnickname].text_width
+        self.fontobj = self.fontobjs[fontnickname]
+        self.tw_func = self.fontobj.text_width
 
         self._fontsize = new_sz
 
@@ -193,6 +196,13 @@ class PSFont:
 ##      return width
         return self.tw_func(self._fontsize, text)
 
+    def word_offsets(self, words):
+        """Return the offsets in font units of WORDS set in the current
+        font with a space after each; see fonts.PSFont.word_offsets().
+        Multiply by font_size() / 1000 for points, as text_width() does.
+        """
+        return self.fontobj.word_offsets(words)
+
     def font_size(self, font_tuple=None):
         """Return the size of the current font, or the font defined by
         optional FONT_TUPLE if present."""
@@ -61,6 +61,8 @@ class PrintingHTMLParser(HTMLParser):
         self._baseurl = context.get_baseurl()
         self.context = context
         self.settings = settings
+        epstools.eps_cache.set_directory(settings.eps_cache_directory,
+                                         settings.eps_cache_size)
         if settings.imageflag:
             self._image_loader = utils.image_loader
         self._image_cache = {}
@@ -549,17 +551,35 @@ class PrintingHTMLParser(HTMLParser):
             if os.path.exists(epsp):
                 self.load_dingbat_eps(key, epsp)
             elif os.path.exists(gifp):
-                try:
-                    newepsp = epstools.convert_gif_to_eps(cog, gifp, epsp)
-                except:
-                    pass
-                else:
-                    self.load_dingbat_eps(key, newepsp)
-                    if newepsp != epsp:
-                        os.unlink(newepsp)
+                self.load_dingbat_gif(key, gifp, epsp)
                 break
         return self.dingbats[key]
 
+    def load_dingbat_gif(self, key, gifp, epsp):
+        """Converts a GIF dingbat to EPS, unless the EPS cache has it.
+        """
+        entname, cog = key
+        try:
+            fp = open(gifp, 'rb')
+            data = fp.read()
+            fp.close()
+        except IOError:
+            return
+        cachekey = epstools.eps_cache.key(data, cog == 'grey')
+        img = epstools.eps_cache.get(cachekey)
+        if img:
+            self.dingbats[key] = img
+            return
+        try:
+            newepsp = epstools.convert_gif_to_eps(cog, gifp, epsp)
+        except:
+            return
+        self.load_dingbat_eps(key, newepsp)
+        if newepsp != epsp:
+            os.unlink(newepsp)
+        if self.dingbats[key]:
+            epstools.eps_cache.put(cachekey, self.dingbats[key])
+
     def load_dingbat_eps(self, key, epsfile):
         """Loads the EPSImage object and stores in the cache.
         """
@@ -583,15 +603,7 @@ class PrintingHTMLParser(HTMLParser):
             raise epstools.EPSError('Image could not be loaded.')
         if not image:
             raise epstools.EPSError('Image could not be loaded.')
-        import tempfile
-        img_fn = tempfile.mktemp()
-        fp = open(img_fn, 'wb')
-        try:
-            fp.write(image)
-        except:
-            raise epstools.EPSError('Failed to write image to external file.')
-        fp.close()
-        return epstools.load_image_file(img_fn, self.settings.greyscale)
+        return epstools.load_image_data(image, self.settings.greyscale)
 
 
 # These functions and classes are "filters" which can be used as anchor
@@ -3,7 +3,7 @@ __version__ = '$Revision: 1.6 $'
 import fonts                            # a package
 import utils                            # || module
 import os
-import regsub
+import re
 import settings
 import string
 import sys
@@ -51,14 +51,12 @@ def get_userheader():
     return string.join(templates, '\n')
 
 
-# Regular expressions.
-L_PAREN = '('
-R_PAREN = ')'
-B_SLASH = '\\\\'
-QUOTE_re = '\\(%c\\|%c\\|%s\\)' % (L_PAREN, R_PAREN, B_SLASH)
+# Characters that must be quoted in PostScript strings, and the
+# precompiled pattern that quotes them all in one pass.
+QUOTE_re = re.compile(r'[()\\]')
 
 def cook(string):
-    return regsub.gsub(QUOTE_re, '\\\\\\1', string)
+    return QUOTE_re.sub(r'\\\g<0>', string)
 
 
 # Keep images that come above the ascenders for the current line
@@ -104,7 +102,10 @@ class PSStream:
     def __init__(self, psfont, ofp, title='', url='', paper=None):
         self._paper = paper
         self._font = psfont
-        self._ofp = ofp
+        # output is collected a page at a time in _ofp, and written to
+        # the real output file by flush_page()
+        self._outfp = ofp
+        self._ofp = StringIO()
         self.set_title(title)
         # strip any fragment identifiers from the url, and pre-cook:
         self.set_url(url)
@@ -342,6 +343,7 @@ class PSStream:
             print "%%EOF"
         finally:
             sys.stdout = oldstdout
+        self.flush_page()
 
     def push_font_change(self, font):
         if self._linestr:
@@ -475,22 +477,52 @@ class PSStream:
 
     def push_string_flowing(self, data):
         allowed_width = self.get_pagewidth()
+        words = string.splitfields(data, ' ')
+        lastword = len(words) - 1
+        # where each word starts and ends in font units, measured from
+        # the first.  widths in points are computed as text_width()
+        # does, so the fit tests below agree with it.
+        starts, ends = self._font.word_offsets(words)
+        fontsize = self._font.font_size()
         # special case getting it on one line:
-        tw = self._font.text_width(data)
+        tw = ends[lastword] * fontsize / 1000
         if tw <= (allowed_width - self._xpos):
             self._linestr.append(data)
             self._xpos = self._xpos + tw
             return
+        widths = map(lambda s, e, fontsize=fontsize: (e - s) * fontsize / 1000,
+                     starts[:-1], ends)
         # local variable cache
         text_width = self._font.text_width
         linestr = self._linestr
         append = linestr.append
         xpos = self._xpos
         # must break line; just do it by "words" as best we understand them
-        words = string.splitfields(data, ' ')
-        wordcnt = len(words) - 1
         space_width = self._space_width
-        for word, width in map(None, words, map(text_width, words)):
+        i = 0
+        while i <= lastword:
+            if xpos > 0.0 or self._inliteral_p:
+                # Append the words that fit on the current line, each
+                # followed by a space (but for the last word), in one
+                # piece.  The widths are added up one at a time, as the
+                # code below does for a single word, so that a line
+                # that ends exactly at the margin breaks the same way.
+                j = i
+                x = xpos
+                while j <= lastword and x + widths[j] < allowed_width:
+                    x = x + widths[j]
+                    if j < lastword:
+                        x = x + space_width
+                    j = j + 1
+                if j > i:
+                    append(string.joinfields(words[i:j], ' '))
+                    if j <= lastword:
+                        append(' ')
+                    xpos = x
+                    i = j
+                    continue
+            word = words[i]
+            width = widths[i]
             # Does the word fit on the current line?
             if xpos + width < allowed_width:
                 append(word)
@@ -564,10 +596,10 @@ class PSStream:
                 xpos = width
             # for every word but the last, put a space after it
             # inlining push_space() for speed
-            if wordcnt > 0 and (self._inliteral_p or xpos > 0.0):
+            if i < lastword and (self._inliteral_p or xpos > 0.0):
                 append(' ')
                 xpos = xpos + space_width
-            wordcnt = wordcnt - 1
+            i = i + 1
         # undo effects of caching variables:
         self._linestr = linestr
         self._xpos = xpos
@@ -612,6 +644,14 @@ class PSStream:
         stdout = sys.stdout
         self._ofp.write("(%s)\n(%s)\n%d EP\n"
                         % (url, title, self.get_pageno()))
+        self.flush_page()
+
+    def flush_page(self):
+        """Write the buffered output to the output file."""
+        ofp = self._ofp
+        self._outfp.write(ofp.getvalue())
+        ofp.seek(0)
+        ofp.truncate()
 
     def push_page_end(self):
         # self._baseline could be None
@@ -640,7 +680,8 @@ class PSStream:
         if baseline is None:
             baseline = self.get_fontsize() + max(yshift, 0.0)
             self._baseline = baseline
-        if not self._linefp.getvalue():
+        linefp = self._linefp
+        if not linefp.tell():
             if self._ypos:
                 self._vtab = self._vtab + baseline
             return
@@ -660,14 +701,15 @@ class PSStream:
             offset = self.get_pagewidth() - self._xpos
         else:
             offset = 0.0
-        self._ofp.write('CR %s -%s R\n%s' %
-                        (offset, distance, self._linefp.getvalue()))
+        self._ofp.write('CR %s -%s R\n' % (offset, distance))
+        self._ofp.write(linefp.getvalue())
         if self._descender > 0:
             self._ofp.write('0 -%s R\n' % self._descender)
             self._descender = 0.0
         # reset cache
         self._line_start_font = self._font.get_font()
-        self._linefp = StringIO()
+        linefp.seek(0)
+        linefp.truncate()
         self._lineshift = yshift
         self._xpos = 0.0
         self._vtab = self._leading
@@ -691,3 +733,47 @@ class PSStream:
         self._linefp.write('(%s) %s\n' % (cooked, render))
         self._prev_render = render
         self._linestr = []
+
+
+def benchmark(pages=1000):
+    """Report how many pages per second PSStream produces for plain
+    paragraphs of text in a mix of fonts."""
+    import PSFont
+    import paper
+    import random
+
+    class NullFile:
+        size = 0
+        def write(self, data):
+            self.size = self.size + len(data)
+
+    words = string.split("""Grail is an extensible Internet browser
+    written entirely in the interpreted object-oriented programming
+    language Python (with a little help from Tk) and supports the
+    display of HTML (including frames and tables) and plain text
+    documents; it can print PostScript output (fonts, images and
+    tables \\ with footnotes) as well.""")
+    random.seed(0)
+    fontspecs = [None, (None, 1, None, None), (None, None, 1, None),
+                 (None, None, None, 1), ('h2', None, 1, None)]
+    ofp = NullFile()
+    ps = PSStream(PSFont.PSFont(), ofp, 'Benchmark', 'file:/benchmark',
+                  paper=paper.PaperInfo('letter', margins=(72, 72, 72, 72)))
+    ps.print_page_preamble()
+    i = 0
+    t0 = time.time()
+    while ps.get_pageno() < pages:
+        ps.push_font_change(fontspecs[i % len(fontspecs)])
+        ps.push_string_flowing(string.join(
+            map(random.choice, [words] * random.randint(10, 150))))
+        ps.close_line()
+        ps.push_paragraph(1, 1.0)
+        i = i + 1
+    ps.push_end()
+    t = time.time() - t0
+    print "%d pages, %d bytes in %.2f sec: %.1f pages/sec" \
+          % (ps.get_pageno(), ofp.size, t, ps.get_pageno() / t)
+
+
+if __name__ == '__main__':
+    benchmark()
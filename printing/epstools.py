@@ -2,10 +2,13 @@
 
 __version__ = '$Revision: 1.5 $'
 
+import hashlib
 import os
 import string
 import sys
 
+from collections import OrderedDict
+
 import utils
 
 
@@ -88,6 +91,33 @@ image_converters = {
     }
 
 
+def load_image_data(data, greyscale):
+    """Generate EPS and the bounding box for an image given as a string.
+
+    Conversions are looked up in, and added to, eps_cache.
+    """
+    key = eps_cache.key(data, greyscale)
+    img = eps_cache.get(key)
+    if img is None:
+        import tempfile
+        img_fn = tempfile.mktemp()
+        fp = open(img_fn, 'wb')
+        try:
+            fp.write(data)
+        except IOError:
+            fp.close()
+            os.unlink(img_fn)
+            raise EPSError('Failed to write image to external file.')
+        fp.close()
+        try:
+            img = load_image_file(img_fn, greyscale)
+        finally:
+            if os.path.exists(img_fn):
+                os.unlink(img_fn)
+        eps_cache.put(key, img)
+    return img
+
+
 def load_image_file(img_fn, greyscale):
     """Generate EPS and the bounding box for an image stored in a file.
 
@@ -222,3 +252,130 @@ def convert_gif_to_eps(cog, giffile, epsfile):
         raise EPSError('Could not run conversion process: %s.'
                        % sys.exc_type)
     return filename
+
+
+class EPSCache:
+    """Converted EPS images, keyed by the image data and the conversion.
+
+    Recently used images are kept in memory, up to memory_size bytes
+    of EPS; when a directory is set, every image is also stored there
+    as <key>.eps and is available to later print jobs.  The files are
+    kept within disk_size bytes (no limit if 0): when a new file takes
+    them over, the least recently used are removed until they fit in
+    low_water of it.
+    """
+
+    low_water = 0.9
+
+    def __init__(self, directory=None, memory_size=2*1024*1024,
+                 disk_size=0):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.size = 0
+        self.disk_used = None           # bytes on disk, once measured
+        self.images = OrderedDict()     # key -> (data, bbox), oldest first
+
+    def set_directory(self, directory, disk_size=0):
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except os.error:
+                directory = None
+        directory = directory or None
+        if directory != self.directory:
+            self.disk_used = None
+        self.directory = directory
+        self.disk_size = disk_size
+
+    def key(self, data, greyscale):
+        digest = hashlib.md5(data).hexdigest()
+        return digest + ((greyscale and '-grey') or '-color')
+
+    def get(self, key):
+        """Return a new EPSImage for key, or None if it is not cached."""
+        if self.images.has_key(key):
+            data, bbox = self.images[key]
+            del self.images[key]
+            self.images[key] = data, bbox
+            return EPSImage(data, bbox)
+        if self.directory:
+            filename = os.path.join(self.directory, key + '.eps')
+            try:
+                img = load_eps(filename)
+            except (IOError, EPSError):
+                return None
+            # the modification time orders files for trim()
+            try:
+                os.utime(filename, None)
+            except os.error:
+                pass
+            self.remember(key, img)
+            return img
+        return None
+
+    def put(self, key, img):
+        self.remember(key, img)
+        if self.directory:
+            # write under a temporary name, so concurrent print jobs
+            # never read a partial file
+            filename = os.path.join(self.directory, key + '.eps')
+            tempname = "%s.%d" % (filename, os.getpid())
+            try:
+                fp = open(tempname, 'w')
+                fp.write(img.data)
+                fp.close()
+                os.rename(tempname, filename)
+            except (IOError, os.error):
+                if os.path.exists(tempname):
+                    os.unlink(tempname)
+                return
+            if self.disk_used is not None:
+                self.disk_used = self.disk_used + len(img.data)
+            if self.disk_size and (self.disk_used is None
+                                   or self.disk_used > self.disk_size):
+                self.trim()
+
+    def trim(self):
+        """Remove the least recently used files until they fit."""
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if os.path.splitext(name)[1] != '.eps':
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except os.error:
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+            total = total + st.st_size
+        if total > self.disk_size:
+            files.sort()
+            target = int(self.disk_size * self.low_water)
+            for mtime, size, filename in files:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(filename)
+                except os.error:
+                    continue
+                total = total - size
+        self.disk_used = total
+
+    def remember(self, key, img):
+        if self.images.has_key(key):
+            self.size = self.size - len(self.images[key][0])
+            del self.images[key]
+        if len(img.data) > self.memory_size:
+            return
+        self.images[key] = img.data, img.bbox
+        self.size = self.size + len(img.data)
+        while self.size > self.memory_size:
+            key, (data, bbox) = self.images.popitem(last=False)
+            self.size = self.size - len(data)
+
+
+#  Shared by all print jobs in the process; the printing settings
+#  provide the directory.
+eps_cache = EPSCache()
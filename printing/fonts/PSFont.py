@@ -17,25 +17,72 @@ import string
 import operator
 import array
 
+# Each font remembers the widths of up to this many strings; the
+# memo is emptied when it fills up.
+WIDTH_CACHE_SIZE = 20000
+
+
 class PSFont:
     def __init__(self, fontname, fullname, metrics):
         self._fontname = fontname
         self._fullname = fullname
         self._metrics = metrics
+        # widths in font units (1/1000 of the font size), by string
+        self._widths = {}
 
     def fontname(self): return self._fontname
     def fullname(self): return self._fullname
 
+    def string_width(self, str):
+        """Return the width of the string in font units (thousandths
+        of the font size)."""
+        widths = self._widths
+        try:
+            return widths[str]
+        except KeyError:
+            if len(widths) >= WIDTH_CACHE_SIZE:
+                widths.clear()
+            width = widths[str] = reduce(
+                operator.add, map(self._metrics.__getitem__, map(ord, str)),
+                0)
+            return width
+
     def text_width(self, fontsize, str):
         """Quickly calculate the width in points of the given string
         in the current font, at the given font size.
         """
-        width = 0
-        metrics = self._metrics
-        for ci in map(ord, str):
-            width = width + metrics[ci]
+        try:
+            width = self._widths[str]
+        except KeyError:
+            width = self.string_width(str)
         return width * fontsize / 1000
 
+    def word_offsets(self, words):
+        """Return the offsets of words set with one space after each.
+
+        Returns two lists of offsets in font units from the start of
+        the first word: starts[i] is where words[i] starts and ends[i]
+        where it ends.  starts has an extra entry, the width of all the
+        words and their spaces.  ends[i] - starts[i] is the width of
+        words[i].
+        """
+        widths = map(self._widths.get, words)
+        if None in widths:
+            string_width = self.string_width
+            for i in range(len(widths)):
+                if widths[i] is None:
+                    widths[i] = string_width(words[i])
+        space = self.string_width(' ')
+        starts = [0]
+        ends = []
+        pos = 0
+        for width in widths:
+            pos = pos + width
+            ends.append(pos)
+            pos = pos + space
+            starts.append(pos)
+        return starts, ends
+
 
 if __name__ == '__main__':
     import PSFont_Times_Roman
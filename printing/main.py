@@ -15,6 +15,8 @@ import os
 import sys
 import posixpath
 import string
+import StringIO
+import time
 import traceback
 import urllib
 import urlparse
@@ -32,6 +34,8 @@ from grailbase.uricontext import URIContext
 
 
 MULTI_DO_PAGE_BREAK = 1                 # changing this breaks stuff
+MULTI_FETCH_WORKERS = 4                 # subdocuments fetched at once
+MULTI_FETCH_AHEAD = 8                   # subdocuments fetched ahead
 
 
 
@@ -42,7 +46,6 @@ MULTI_DO_PAGE_BREAK = 1                 # changing this breaks stuff
 def run(app):
     global logfile
     import getopt
-    import paper
     import settings
     settings = settings.get_settings(app.prefs)
     # do this after loading the settings so the user can just call
@@ -61,21 +64,27 @@ def run(app):
     copies = 1
     levels = None
     outfile = None
+    outdir = None
+    batch = None
+    jobs = None
     #
     try:
         options, args = getopt.getopt(sys.argv[1:],
                                       'mvhdcaUl:u:t:sp:o:f:C:P:T:',
-                                      ['color',
+                                      ['batch=',
+                                       'color',
                                        'copies=',
                                        'debug',
                                        'fontsize=',
                                        'footnote-anchors',
                                        'help',
                                        'images',
+                                       'jobs=',
                                        'logfile=',
                                        'multi',
                                        'orientation=',
                                        'output=',
+                                       'output-dir=',
                                        'papersize=',
                                        'paragraph-indent=',
                                        'paragraph-skip=',
@@ -132,6 +141,12 @@ def run(app):
             verbose = verbose + 1
         elif opt == '--output':
             outfile = arg
+        elif opt == '--output-dir':
+            outdir = arg
+        elif opt == '--batch':
+            batch = arg
+        elif opt == '--jobs':
+            jobs = max(string.atoi(arg), 1)
         elif opt == '--tags':
             if not load_tag_handler(app, arg):
                 error = 2
@@ -151,6 +166,10 @@ def run(app):
         try: sys.stderr = open(logfile, 'a')
         except IOError: sys.stderr = stderr
     utils.debug("Using Python version " + sys.version)
+    if batch:
+        run_batch(app, settings, batch, outdir, jobs,
+                  title=title, tabstop=tabstop, multi=multi, levels=levels)
+        return
     # crack open the input file, or stdin
     outfp = None
     if printer:
@@ -182,11 +201,20 @@ def run(app):
     if outfile != '-':
         print 'Outputting PostScript to', outfile
 
+    convert(app, settings, infp, outfp, url or infile, title, tabstop,
+            multi, args[1:], levels, verbose)
+
+
+def convert(app, settings, infp, outfp, url=None, title='', tabstop=None,
+            multi=0, subdocs=(), levels=None, verbose=0):
+    """Convert the HTML document read from infp to PostScript on outfp.
+
+    The settings are shared by every conversion; url is the document's
+    address, or None when it is read from stdin.
+    """
+    import printing.paper
     if url:
         context = URIContext(url)
-    elif infile:
-        url = infile
-        context = URIContext(url)
     else:
         # BOGOSITY: reading from stdin
         context = URIContext("file:/index.html")
@@ -209,8 +237,8 @@ def run(app):
         sys.exit("cannot load printing support for " + ctype)
     p = mod.parse(w, settings, context)
     if multi:
-        if args[1:]:
-            xform = explicit_multi_transform(args[1:])
+        if subdocs:
+            xform = explicit_multi_transform(subdocs)
         else:
             xform = multi_transform(context, levels)
         p.add_anchor_transform(xform)
@@ -221,48 +249,232 @@ def run(app):
         # internally to accumulate subdocs.  Make a copy to go only one
         # level deep.
         #
-        for url in xform.get_subdocs():
-            xform.set_basedoc(url)
-            while p.sgml_parser.get_depth():
-                p.sgml_parser.lex_endtag(p.sgml_parser.get_stack()[0])
-            try:
-                infp, fn = open_source(url)
-            except IOError, err:
-                if verbose and outfp is not sys.stdout:
-                    print "Error opening subdocument", url
-                    print "   ", err
-            else:
-                new_ctype = get_ctype(app, url, infp)
-                if new_ctype != ctype:
-                    if verbose:
-                        print "skipping", url
-                        print "  wrong content type:", new_ctype
-                    continue
-                if verbose and outfp is not sys.stdout:
-                    print "Subdocument", url
-                w.ps.close_line()
-                if MULTI_DO_PAGE_BREAK: # must be true for now, not sure why
-                    pageend = w.ps.push_page_end()
-                    context.set_url(url)
-                    w.ps.set_pageno(w.ps.get_pageno() + 1)
-                    w.ps.set_url(url)
-                    w.ps.push_page_start(pageend)
+        # Subdocuments are fetched ahead on worker threads; parsing
+        # stays in document order, since page numbers and footnote
+        # numbers run on from one subdocument to the next.
+        #
+        fetcher = SubdocumentFetcher(MULTI_FETCH_WORKERS)
+        subdocs = xform.get_subdocs()
+        try:
+            index = 0
+            for url in subdocs:
+                index = index + 1
+                fetcher.prefetch(subdocs[index:index + MULTI_FETCH_AHEAD])
+                xform.set_basedoc(url)
+                while p.sgml_parser.get_depth():
+                    p.sgml_parser.lex_endtag(p.sgml_parser.get_stack()[0])
+                try:
+                    infp, fn = fetcher.get(url)
+                except IOError, err:
+                    if verbose and outfp is not sys.stdout:
+                        print "Error opening subdocument", url
+                        print "   ", err
                 else:
-                    context.set_url(url)
-                    w.ps.set_url(url)
-                pageno = w.ps.get_pageno()
-                p.feed(infp.read())
-                infp.close()
-                title = w.ps.get_title()
-                p._set_docinfo(url, pageno, title)
-                spec = (url, pageno, title, xform.get_level(url))
-                docs.append(spec)
+                    new_ctype = get_ctype(app, url, infp)
+                    if new_ctype != ctype:
+                        if verbose:
+                            print "skipping", url
+                            print "  wrong content type:", new_ctype
+                        continue
+                    if verbose and outfp is not sys.stdout:
+                        print "Subdocument", url
+                    w.ps.close_line()
+                    # must be true for now, not sure why
+                    if MULTI_DO_PAGE_BREAK:
+                        pageend = w.ps.push_page_end()
+                        context.set_url(url)
+                        w.ps.set_pageno(w.ps.get_pageno() + 1)
+                        w.ps.set_url(url)
+                        w.ps.push_page_start(pageend)
+                    else:
+                        context.set_url(url)
+                        w.ps.set_url(url)
+                    pageno = w.ps.get_pageno()
+                    p.feed(infp.read())
+                    infp.close()
+                    title = w.ps.get_title()
+                    p._set_docinfo(url, pageno, title)
+                    spec = (url, pageno, title, xform.get_level(url))
+                    docs.append(spec)
+        finally:
+            fetcher.close()
     else:
         p.feed(infp.read())
     p.close()
     w.close()
 
 
+
+#  Batch conversion....
+
+
+def run_batch(app, settings, source, outdir=None, jobs=None, **options):
+    """Convert many documents with one set of options, reporting the
+    time taken by each.
+
+    The source is a manifest file listing an input and, optionally, an
+    output file on each line, a directory whose HTML files are
+    converted, or unix:PATH to serve conversion requests on a local
+    socket.  Output files default to the input name with a .ps
+    extension, in outdir if one is given.
+    """
+    start_worker(app, settings, options)
+    if jobs is None:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        # each worker is handed the settings when it starts, since a
+        # spawned (rather than forked) worker does not inherit them
+        pool = ProcessPoolExecutor(jobs, initializer=start_worker,
+                                   initargs=(app, settings, options))
+    else:
+        pool = None
+    try:
+        if source[:5] == "unix:":
+            serve_batch(source[5:], outdir, pool)
+        else:
+            if os.path.isdir(source):
+                requests = read_directory(source)
+            else:
+                requests = read_requests(open(source))
+            t0 = time.time()
+            errors = 0
+            for result in convert_batch(requests, outdir, pool):
+                sys.stdout.write(format_result(result))
+                if result[3]:
+                    errors = errors + 1
+            print "%d documents in %.2f sec, %d failed" \
+                  % (len(requests), time.time() - t0, errors)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def start_worker(app, settings, options):
+    """Set up this process to run convert_file() with the batch's
+    application, settings and conversion options."""
+    global _batch
+    _batch = app, settings, options
+    warm_up(app, settings)
+
+
+def warm_up(app, settings):
+    """Load the font metrics and convert an empty document, so the
+    work done once per process is not charged to the first request."""
+    import PSFont
+    for psfontname in PSFont.PSFont().docfonts.values():
+        fonts.font_from_name(psfontname)
+    outfp = open(os.devnull, 'w')
+    try:
+        convert(app, settings, StringIO.StringIO("<title></title>"), outfp)
+    finally:
+        outfp.close()
+
+
+def read_requests(fp):
+    """Read (infile[, outfile]) requests from fp, one per line."""
+    requests = []
+    for line in fp.readlines():
+        fields = string.split(line)
+        if fields and fields[0][0] != '#':
+            requests.append(tuple(fields[:2]))
+    return requests
+
+
+def read_directory(dirname):
+    requests = []
+    names = os.listdir(dirname)
+    names.sort()
+    for name in names:
+        if string.lower(os.path.splitext(name)[1]) in ('.html', '.htm'):
+            requests.append((os.path.join(dirname, name),))
+    return requests
+
+
+def convert_batch(requests, outdir=None, pool=None):
+    """Convert each (infile[, outfile]) request, in parallel if a
+    worker pool is given; return (infile, outfile, seconds, error)
+    tuples in request order."""
+    jobs = []
+    for request in requests:
+        infile = request[0]
+        if request[1:]:
+            outfile = request[1]
+        else:
+            outfile = os.path.splitext(infile)[0] + '.ps'
+            if outdir:
+                outfile = os.path.join(outdir, os.path.basename(outfile))
+        jobs.append((infile, outfile))
+    if pool is None:
+        return map(convert_file, jobs)
+    futures = map(pool.submit, [convert_file] * len(jobs), jobs)
+    return map(lambda future: future.result(), futures)
+
+
+def convert_file((infile, outfile)):
+    """Convert one document of a batch; errors are returned, not raised."""
+    app, settings, options = _batch
+    t0 = time.time()
+    error = None
+    try:
+        infp, fn = open_source(infile)
+        try:
+            outfp = open(outfile, 'w')
+            try:
+                convert(app, settings, infp, outfp, infile, **options)
+            finally:
+                outfp.close()
+        finally:
+            infp.close()
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        if utils.get_debugging():
+            traceback.print_exc()
+        t, v = sys.exc_info()[:2]
+        error = "%s: %s" % (getattr(t, '__name__', t), v)
+    return infile, outfile, time.time() - t0, error
+
+
+def format_result((infile, outfile, seconds, error)):
+    if error:
+        return "error %.3f %s %s\n" % (seconds, infile, error)
+    return "ok %.3f %s %s\n" % (seconds, infile, outfile)
+
+
+def serve_batch(path, outdir=None, pool=None):
+    """Serve conversion requests on the local socket path.
+
+    A client sends one request per line, an input and optionally an
+    output file, then shuts down its side of the connection; the
+    reply is one line per request, in order, as written by
+    format_result().
+    """
+    import socket
+    if os.path.exists(path):
+        os.unlink(path)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(5)
+    print "Serving conversion requests on", path
+    try:
+        while 1:
+            conn, addr = s.accept()
+            try:
+                fp = conn.makefile('r')
+                requests = read_requests(fp)
+                fp.close()
+                for result in convert_batch(requests, outdir, pool):
+                    sys.stdout.write(format_result(result))
+                    conn.sendall(format_result(result))
+            finally:
+                conn.close()
+    finally:
+        s.close()
+        os.unlink(path)
+
+
 
 #  Lots of helper functions....
 
@@ -342,6 +554,60 @@ def open_source(infile):
     return infp, fn
 
 
+class FetchedSource:
+    """A document read in full by open_source(), for the parser to read
+    later in place of the file object."""
+
+    def __init__(self, url):
+        infp, self.filename = open_source(url)
+        if hasattr(infp, 'info'):
+            self.info = infp.info
+        try:
+            self.data = infp.read()
+        finally:
+            infp.close()
+
+    def read(self):
+        data = self.data
+        self.data = ''
+        return data
+
+    def close(self):
+        self.data = ''
+
+
+class SubdocumentFetcher:
+    """Fetch the subdocuments of a --multi job on a pool of worker threads.
+
+    prefetch() starts fetching URLs the job will need soon; get()
+    returns a URL's (file, filename) like open_source(), waiting for
+    its fetch to finish if needed.
+    """
+
+    def __init__(self, workers):
+        from concurrent.futures import ThreadPoolExecutor
+        self.__pool = ThreadPoolExecutor(workers)
+        self.__pending = {}
+
+    def prefetch(self, urls):
+        for url in urls:
+            if not self.__pending.has_key(url):
+                self.__pending[url] = self.__pool.submit(FetchedSource, url)
+
+    def get(self, url):
+        self.prefetch([url])
+        future = self.__pending[url]
+        del self.__pending[url]
+        source = future.result()
+        return source, source.filename
+
+    def close(self):
+        for future in self.__pending.values():
+            future.cancel()
+        self.__pending.clear()
+        self.__pool.shutdown()
+
+
 class multi_transform:
     def __init__(self, context, levels=None):
         self.__app = context.app
@@ -454,6 +720,13 @@ def usage(settings):
     print '    -m: descend tree starting from specified document,'
     print '        printing all HTML documents found'
     print '    -h: this help message'
+    print '    --batch: convert the documents named in a manifest file, each'
+    print '        HTML file in a directory, or each request sent to the'
+    print '        local socket unix:PATH'
+    print '    --output-dir: directory for batch output files that are not'
+    print '        named in the request (default is next to the input)'
+    print '    --jobs: number of batch conversions run at once'
+    print '        (default is one per CPU)'
     print '[file]: file to convert, otherwise from stdin'
 
 
@@ -502,3 +775,42 @@ def profile_main(n=18):
         p.strip_dirs().sort_stats('time').print_stats(n)
         p.print_callers(n)
         p.sort_stats('cum').print_stats(n)
+
+
+def benchmark_main(paragraphs=3000):
+    """Time the conversion of a large generated document to PostScript."""
+    import random
+    import tempfile
+    import time
+    words = string.split(__doc__)
+    random.seed(0)
+    def sentence(n, words=words, choice=random.choice):
+        return string.join(map(choice, [words] * n))
+    parts = ["<html><head><title>Benchmark</title></head><body>"]
+    for i in range(paragraphs):
+        if i % 50 == 0:
+            parts.append("<h2>Section %d</h2>" % (i / 50 + 1))
+        parts.append("<p>%s <b>%s</b> %s <i>%s</i> %s"
+                     % (sentence(random.randint(10, 80)), sentence(3),
+                        sentence(random.randint(10, 80)), sentence(2),
+                        sentence(random.randint(0, 40))))
+        if i % 10 == 0:
+            parts.append("<ul><li>%s<li>%s</ul>"
+                         % (sentence(12), sentence(25)))
+        if i % 25 == 0:
+            parts.append("<pre>%s</pre>" % sentence(30))
+    parts.append("</body></html>")
+    data = string.join(parts, "\n")
+    infile = tempfile.mktemp(".html")
+    f = open(infile, "w")
+    f.write(data)
+    f.close()
+    sys.argv[1:] = ["--output", "/dev/null", infile]
+    try:
+        t0 = time.time()
+        main()
+        t = time.time() - t0
+    finally:
+        os.unlink(infile)
+    sys.stderr.write("%d paragraphs (%d bytes) in %.2f sec\n"
+                     % (paragraphs, len(data), t))
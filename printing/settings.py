@@ -12,6 +12,7 @@ def get_settings(prefs=None):
     return _settings
 
 
+import os
 import string
 import utils                            # || module
 
@@ -38,6 +39,8 @@ class PrintSettings:
     strict_parsing = 0
     postscript_level = 1
     paragraph_indent = 0.0
+    eps_cache_directory = None
+    eps_cache_size = 0
     # Proper values for a Sun 20" 1152 x 900 pixel display:
     horizontal_scaling = 0.8125
     vertical_scaling = 0.8128
@@ -76,6 +79,14 @@ class PrintSettings:
         self.printcmd = prefs.Get(self.GROUP, 'command') or self.PRINTCMD
         self.paragraph_indent = prefs.GetFloat(self.GROUP, 'paragraph-indent')
         self.paragraph_skip = prefs.GetFloat(self.GROUP, 'paragraph-skip')
+        self.eps_cache_directory = None
+        self.eps_cache_size = prefs.GetInt(self.GROUP, 'eps-cache-size') \
+                              * 1024
+        directory = prefs.Get(self.GROUP, 'eps-cache-directory')
+        if directory:
+            import grailutil
+            self.eps_cache_directory = os.path.join(grailutil.getgraildir(),
+                                                    directory)
 
     def get_fontsize(self):
         return self.fontsize, self.leading
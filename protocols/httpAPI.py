@@ -5,12 +5,13 @@ test ProtocolAPI.py.  Especially the way it uses knowledge about the
 internals of httplib.HTTP is disgusting (but then, so would editing
 the source of httplib.py be :-).
 
-XXX Main deficiencies:
+Requests are sent as HTTP/1.1.  When the server keeps the connection
+open and the response body is delimited (by Content-Length or the
+chunked transfer-coding), the socket goes back to a ConnectionPool
+once the body has been read, and later requests to the same host:port
+reuse it instead of connecting again.
 
-- poll*() always returns ready
-- should read the headers more carefully (no blocking)
-- (could even *write* the headers more carefully)
-- should poll the connection making part too
+The exchange itself is a non-blocking state machine; see http_access.
 
 """
 
@@ -18,15 +19,16 @@ XXX Main deficiencies:
 import string
 import httplib
 from urllib import splithost
-import mimetools
 from Assert import Assert
 import grailutil
 import select
 import Reader
 import regex
-import StringIO
 import socket
 import sys
+import time
+import os
+import errno
 from __main__ import GRAILVERSION
 
 
@@ -38,32 +40,312 @@ httplib.replypat = replypat
 httplib.replyprog = replyprog
 
 
-# Search for blank line following HTTP headers
-endofheaders = regex.compile("\n[ \t]*\r?\n")
+# Bytes read from the socket at a time
+BUFSIZE = 8*1024
+
+# Milliseconds between polls while the request is being sent
+SEND_POLL = 10
 
 
 # Stages
-# there are now five stages
+# there are now six stages
 WAIT = 'wait'  # waiting for a socket
+SEND = 'send'  # connecting and sending the request
 META = 'meta'
 DATA = 'data'
 DONE = 'done'
 CLOS = 'closed'
 
-class MyHTTP(httplib.HTTP):
+class ConnectionPool:
+    """Idle persistent HTTP/1.1 connections, keyed by 'host:port'.
+
+    A connection whose response was completely read and that the
+    server agreed to keep open is put() here instead of being closed;
+    the next request for the same host:port get()s it back.  At most
+    max_per_host idle connections are kept per key, and connections
+    idle for longer than idle_timeout seconds are closed.  Idle
+    connections do not hold a SocketQueue slot; a request holds one
+    slot whether its connection is fresh or pooled.
+    """
+
+    def __init__(self, max_per_host=2, idle_timeout=30.0):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}                  # key -> [(sock, time put), ...]
+
+    def get(self, key):
+        """Return an idle connection for key, or None."""
+        self.expire()
+        conns = self.idle.get(key)
+        while conns:
+            sock, t = conns.pop()
+            # an idle connection should have nothing to say; if it is
+            # readable the server closed it (or sent garbage)
+            try:
+                readable = select.select([sock], [], [], 0)[0]
+            except (select.error, socket.error):
+                readable = 1
+            if not readable:
+                if not conns:
+                    del self.idle[key]
+                return sock
+            close_socket(sock)
+        if key in self.idle:
+            del self.idle[key]
+        return None
+
+    def put(self, key, sock):
+        """Keep sock open for reuse by a later request for key."""
+        conns = self.idle.setdefault(key, [])
+        conns.append((sock, time.time()))
+        while len(conns) > self.max_per_host:
+            close_socket(conns.pop(0)[0])
+        self.expire()
+
+    def expire(self):
+        """Close connections that have been idle too long."""
+        limit = time.time() - self.idle_timeout
+        for key, conns in list(self.idle.items()):
+            while conns and conns[0][1] < limit:
+                close_socket(conns.pop(0)[0])
+            if not conns:
+                del self.idle[key]
+
+    def close_all(self):
+        for conns in self.idle.values():
+            for sock, t in conns:
+                close_socket(sock)
+        self.idle = {}
+
+
+pool = ConnectionPool()
+
+
+def close_socket(sock):
+    try:
+        sock.close()
+    except socket.error:
+        # What can you do? :-)
+        pass
+
+
+def split_host_port(host):
+    """Split 'host[:port]' into (host, port), defaulting to port 80."""
+    i = host.rfind(':')
+    if i >= 0 and host[i+1:].isdigit():
+        return host[:i], int(host[i+1:])
+    return host, httplib.HTTP_PORT
+
+
+class ChunkedDecoder:
+    """Incremental decoder for the chunked transfer-coding.
+
+    feed() takes raw body data as it arrives and returns the decoded
+    data it completes; done is set once the last chunk and the
+    trailer have been seen.  Anything after the end of the body is
+    left in extra.
+    """
+
+    def __init__(self):
+        self.buf = ''
+        self.left = 0                   # data left in the current chunk
+        self.state = 'size'
+        self.done = 0
+        self.extra = ''
+
+    def feed(self, data):
+        if self.done:
+            self.extra = self.extra + data
+            return ''
+        buf = self.buf + data
+        out = []
+        i = 0
+        while not self.done:
+            if self.state == 'data':
+                n = min(self.left, len(buf) - i)
+                if n:
+                    out.append(buf[i:i+n])
+                    i = i + n
+                    self.left = self.left - n
+                if self.left:
+                    break
+                self.state = 'crlf'
+                continue
+            j = buf.find('\n', i)
+            if j < 0:
+                break
+            line = buf[i:j].strip()
+            i = j + 1
+            if self.state == 'crlf':
+                # end of chunk data
+                self.state = 'size'
+            elif self.state == 'size':
+                if not line:
+                    continue
+                try:
+                    size = int(line.split(';')[0], 16)
+                except ValueError:
+                    raise IOError("bad chunk size in HTTP response")
+                if size:
+                    self.left = size
+                    self.state = 'data'
+                else:
+                    self.state = 'trailer'
+            elif not line:
+                # blank line ends the trailer
+                self.done = 1
+                self.extra = buf[i:]
+                i = len(buf)
+        self.buf = buf[i:]
+        return ''.join(out)
+
+
+def find_end_of_headers(buf, start=0):
+    """Return the offset just past the blank line ending the headers.
+
+    Searches buf from start; returns -1 if the headers are not
+    complete yet.
+    """
+    ends = []
+    for sep in ('\n\n', '\n\r\n'):
+        i = buf.find(sep, start)
+        if i >= 0:
+            ends.append(i + len(sep))
+    if ends:
+        return min(ends)
+    return -1
+
+
+def parse_headers(block):
+    """Parse a block of header lines into a dictionary.
+
+    Keys are lower-cased; continuation lines are folded in and
+    repeated headers are joined with commas.
+    """
+    headers = {}
+    name = None
+    for line in block.split('\n'):
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        if line[0] in ' \t':
+            if name:
+                headers[name] = headers[name] + ' ' + line.strip()
+            continue
+        i = line.find(':')
+        if i <= 0:
+            continue
+        name = line[:i].strip().lower()
+        value = line[i+1:].strip()
+        if headers.has_key(name):
+            headers[name] = headers[name] + ', ' + value
+        else:
+            headers[name] = value
+    return headers
+
+
+class MyHTTP:
+    """One HTTP/1.1 request and response on a possibly pooled socket.
+
+    Keeps the putrequest()/putheader()/endheaders()/send() interface
+    of httplib.HTTP, but never blocks: the socket is non-blocking,
+    connect() only starts connecting, and the request is queued in
+    outbuf and written by write_some() as the socket becomes
+    writable.  The socket comes from the connection pool when it can;
+    the whole request is remembered so that it can be sent again on
+    a fresh connection if a pooled one turns out to have been closed
+    by the server (see retry()).
+
+    Only the host name lookup in connect() may still block.
+    """
+
+    debuglevel = 0
+
+    def __init__(self, host):
+        self.host, self.port = split_host_port(host)
+        self.key = '%s:%d' % (self.host, self.port)
+        self.request = []
+        self.outbuf = ''
+        self.sock = pool.get(self.key)
+        self.reused = self.sock is not None
+        if self.sock:
+            self.sock.setblocking(0)
+            self.connected = 1
+        else:
+            self.connect()
+
+    def connect(self):
+        """Start a non-blocking connect."""
+        family, socktype, proto, name, addr = socket.getaddrinfo(
+            self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(addr)
+        if err and err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        self.connected = not err
 
     def putrequest(self, request, selector):
         self.selector = selector
-        httplib.HTTP.putrequest(self, request, selector)
+        self.request = ['%s %s HTTP/1.1\r\n' % (request, selector)]
+
+    def putheader(self, header, value):
+        self.request.append('%s: %s\r\n' % (header, value))
 
-    def getreply(self, file):
-        self.file = file
-        line = self.file.readline()
+    def endheaders(self):
+        self.request.append('\r\n')
+        self.outbuf = ''.join(self.request)
+
+    def send(self, data):
+        self.request.append(data)
+        self.outbuf = self.outbuf + data
+
+    def write_some(self, timeout=0):
+        """Make progress connecting and sending the request.
+
+        Waits up to timeout seconds (forever if None) for the socket
+        to become writable.  Returns true once the whole request has
+        been sent; raises socket.error if connecting failed.
+        """
+        if not select.select([], [self.sock], [], timeout)[1]:
+            return not self.outbuf and self.connected
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.connected = 1
+        if self.outbuf:
+            try:
+                n = self.sock.send(self.outbuf)
+            except socket.error, msg:
+                if msg.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                n = 0
+            self.outbuf = self.outbuf[n:]
+        return not self.outbuf
+
+    def retry(self):
+        """Resend the request on a fresh connection.
+
+        Only valid when the pooled connection died before any of the
+        response arrived.
+        """
+        close_socket(self.sock)
+        self.reused = 0
+        self.connect()
+        self.outbuf = ''.join(self.request)
+
+    def getreply(self, block):
+        """Parse the status line and headers in block.
+
+        block holds everything up to the end of the headers.
+        """
+        i = block.find('\n')
+        line = block[:i+1]
         if self.debuglevel > 0: print 'reply:', `line`
         if replyprog.match(line) < 0:
-            # Not an HTTP/1.0 response.  Fall back to HTTP/0.9.
-            # Push the data back into the file.
-            self.file.seek(-len(line), 1)
+            # Not an HTTP/1.x response.  Fall back to HTTP/0.9.
+            self.version = 'HTTP/0.9'
             self.headers = {}
             app = grailutil.get_grailapp()
             c_type, c_encoding = app.guess_type(self.selector)
@@ -72,39 +354,69 @@ class MyHTTP(httplib.HTTP):
             # HTTP/0.9 sends HTML by default
             self.headers['content-type'] = c_type or "text/html"
             return 200, "OK", self.headers
+        self.version = line.split()[0]
         errcode, errmsg = replyprog.group(1, 2)
         errcode = string.atoi(errcode)
         errmsg = string.strip(errmsg)
-        self.headers = mimetools.Message(self.file, 0)
+        self.headers = parse_headers(block[i+1:])
         return errcode, errmsg, self.headers
 
-    def close(self):
-        if self.file:
-            self.file.close()
-        if self.sock:
-            try:
-                self.sock.close()
-            except socket.error:
-                # What can you do? :-)
-                pass
-        self.file = None
+    def release(self, reusable):
+        """Done with the socket: pool it if reusable, else close it."""
+        sock = self.sock
         self.sock = None
+        if sock:
+            if reusable:
+                pool.put(self.key, sock)
+            else:
+                close_socket(sock)
+
+    def close(self):
+        self.release(0)
 
 
 class http_access:
+    """Non-blocking HTTP request/response state machine.
+
+    The stages are WAIT (for a SocketQueue slot), SEND (connecting
+    and writing the request), META (reading the status line and
+    headers), DATA, DONE and CLOS.  Nothing here blocks except a
+    getmeta() or getdata() call made before the poll routine said it
+    was ready, and the host name lookup:
+
+    - open() starts a non-blocking connect.  When the application has
+      a Tk root a timer drives the connect and the request out;
+      otherwise pollmeta() does.  (The reader owns the socket's file
+      handler, and Tk keeps only one per descriptor.)
+    - pollmeta() reads whatever the socket has into readahead and
+      scans only the new bytes for the end of the headers.
+    - polldata() reads and decodes whatever the socket has into
+      pending, and is ready only when there is decoded data or the
+      body is complete.
+
+    Errors that happen in the background (e.g. a refused connection)
+    are kept in self.error and raised as IOError by the next poll.
+    """
 
     def __init__(self, resturl, method, params, data=None):
         self.app = grailutil.get_grailapp()
         self.args = (resturl, method, params, data)
         self.state = WAIT
         self.h = None
+        self.error = None
+        self.send_timer = None
         self.reader_callback = None
-        self.app.sq.request_socket(self, self.open)
+        if type(resturl) == type(()):
+            host = resturl[0]
+        else:
+            host = splithost(resturl)[0]
+        priority = params.get('.priority', 'document')
+        self.app.sq.request_socket(self, self.open, host, priority)
 
     def register_reader(self, reader_callback, ignore):
-        if self.state == WAIT:
-            self.reader_callback = reader_callback
-        else:
+        # also called again by retry() when the socket changes
+        self.reader_callback = reader_callback
+        if self.state != WAIT:
             # we've been waitin' fer ya
             reader_callback()
 
@@ -131,42 +443,109 @@ class http_access:
             auth = string.strip(base64.encodestring(user_passwd))
         else:
             auth = None
-        self.h = MyHTTP(host)
-        self.h.putrequest(method, selector)
-        self.h.putheader('User-agent', GRAILVERSION)
-        if auth:
-            self.h.putheader('Authorization', 'Basic %s' % auth)
-        if not params.has_key('host'):
-            self.h.putheader('Host', host)
-        if not params.has_key('accept-encoding'):
-            encodings = Reader.get_content_encodings()
-            if encodings:
-                encodings.sort()
-                self.h.putheader(
-                    'Accept-Encoding', string.join(encodings, ", "))
-        for key, value in params.items():
-            if key[:1] != '.':
-                self.h.putheader(key, value)
-        self.h.putheader('Accept', '*/*')
-        self.h.endheaders()
-        if data:
-            self.h.send(data)
+        pool.max_per_host = self.app.prefs.GetInt('sockets',
+                                                  'keepalive-per-host')
+        pool.idle_timeout = self.app.prefs.GetFloat('sockets',
+                                                    'keepalive-timeout')
+        self.method = method
         self.readahead = ""
-        self.state = META
+        self.scanned = 0
         self.line1seen = 0
+        self.meta_ready = None
+        self.body_done = 0
+        self.reusable = 0
+        self.pending = ""
+        self.excess = ""
+        self.state = SEND
+        try:
+            self.h = MyHTTP(host)
+        except socket.error, msg:
+            self.error = msg
+        else:
+            self.h.putrequest(method, selector)
+            self.h.putheader('User-agent', GRAILVERSION)
+            if auth:
+                self.h.putheader('Authorization', 'Basic %s' % auth)
+            if not params.has_key('host'):
+                self.h.putheader('Host', host)
+            if not params.has_key('accept-encoding'):
+                encodings = Reader.get_content_encodings()
+                if encodings:
+                    encodings.sort()
+                    self.h.putheader(
+                        'Accept-Encoding', string.join(encodings, ", "))
+            for key, value in params.items():
+                if key[:1] != '.':
+                    self.h.putheader(key, value)
+            self.h.putheader('Accept', '*/*')
+            self.h.endheaders()
+            if data:
+                self.h.send(data)
+            self.watch_writable()
         if self.reader_callback:
             self.reader_callback()
 
+    def watch_writable(self):
+        """Poll from a Tk timer until the request has been sent."""
+        root = getattr(self.app, 'root', None)
+        if root is None:
+            return
+        self.unwatch_writable()
+        self.send_timer = root.after_idle(self.writable)
+
+    def unwatch_writable(self):
+        if self.send_timer is not None:
+            self.app.root.after_cancel(self.send_timer)
+            self.send_timer = None
+
+    def writable(self):
+        self.send_timer = None
+        if self.state != SEND or self.error:
+            return
+        try:
+            self.send_request(0)
+        except socket.error, msg:
+            # the reader's file handler sees the failed socket and
+            # gets the error from pollmeta()
+            self.error = msg
+            return
+        if self.state == SEND:
+            self.send_timer = self.app.root.after(SEND_POLL, self.writable)
+
+    def send_request(self, timeout):
+        """Advance connecting and sending; move to META once sent."""
+        if self.state == SEND and self.h.write_some(timeout):
+            self.state = META
+
+    def check_error(self):
+        if self.error:
+            raise IOError, self.error
+
     def close(self):
+        self.unwatch_writable()
         if self.h:
-            self.h.close()
+            self.h.release(self.body_done and self.reusable)
         if self.state != CLOS:
             self.app.sq.return_socket(self)
             self.state = CLOS
         self.h = None
 
     def pollmeta(self, timeout=0):
+        self.check_error()
+        if self.state == SEND:
+            try:
+                self.send_request(timeout)
+            except socket.error, msg:
+                self.unwatch_writable()
+                self.error = msg
+                raise IOError, msg, sys.exc_traceback
+            if self.state == SEND:
+                if self.h.connected:
+                    return "sending request", 0
+                return "connecting", 0
         Assert(self.state == META)
+        if self.meta_ready:
+            return self.meta_ready, 1
 
         sock = self.h.sock
         try:
@@ -177,12 +556,16 @@ class http_access:
         try:
             new = sock.recv(1024)
         except socket.error, msg:
+            if msg.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return "waiting for server response", 0
+            if self.h.reused and not self.readahead:
+                return self.retry()
             raise IOError, msg, sys.exc_traceback
         if not new:
-            return "EOF in server response", 1
+            if self.h.reused and not self.readahead:
+                return self.retry()
+            return self.ready("EOF in server response")
         self.readahead = self.readahead + new
-        if '\n' not in new:
-            return "receiving server response", 0
         if not self.line1seen:
             i = string.find(self.readahead, '\n')
             if i < 0:
@@ -190,48 +573,159 @@ class http_access:
             self.line1seen = 1
             line = self.readahead[:i+1]
             if replyprog.match(line) < 0:
-                return "received non-HTTP/1.0 server response", 1
-        i = endofheaders.search(self.readahead)
+                return self.ready("received non-HTTP/1.0 server response")
+        # only look at what arrived since the last scan
+        i = find_end_of_headers(self.readahead, max(0, self.scanned - 2))
+        self.scanned = len(self.readahead)
         if i >= 0:
-            return "received server response", 1
+            return self.ready("received server response")
         return "receiving server response", 0
 
+    def ready(self, message):
+        """Remember that the reply can be parsed now."""
+        self.meta_ready = message
+        return message, 1
+
+    def retry(self):
+        """A pooled connection was closed under us; start over."""
+        self.h.retry()
+        self.state = SEND
+        self.watch_writable()
+        if self.reader_callback:
+            # move the reader's file handler to the new socket
+            self.reader_callback()
+        return "connecting", 0
+
     def getmeta(self):
-        Assert(self.state == META)
-        if not self.readahead:
+        if self.state != DATA:
             x, y = self.pollmeta(None)
             while not y:
                 x, y = self.pollmeta(None)
-        file = StringIO.StringIO(self.readahead)
-        errcode, errmsg, headers = self.h.getreply(file)
+        Assert(self.state == META)
+        if self.line1seen and replyprog.match(self.readahead) >= 0:
+            i = find_end_of_headers(self.readahead)
+            if i < 0:
+                # EOF in the headers; use what we have
+                i = len(self.readahead)
+        else:
+            i = 0
+        errcode, errmsg, headers = self.h.getreply(self.readahead[:i])
         self.state = DATA
-        self.readahead = file.read()
+        rest = self.readahead[i:]
+        self.readahead = ""
+        self.setup_body(errcode, headers)
+        if rest and not self.body_done:
+            self.consume(rest)
         return errcode, errmsg, headers
 
+    def setup_body(self, errcode, headers):
+        """Work out how the body is delimited and if the socket is reusable.
+
+        Sets self.length (bytes of body left, or None to read until
+        EOF) or self.chunked (a ChunkedDecoder), and self.keepalive.
+        """
+        version = self.h.version
+        connection = string.lower(headers.get('connection', ''))
+        if version == 'HTTP/1.1':
+            self.keepalive = 'close' not in connection
+        elif version == 'HTTP/1.0':
+            self.keepalive = 'keep-alive' in connection
+        else:
+            self.keepalive = 0
+        self.length = None
+        self.chunked = None
+        encoding = string.lower(headers.get('transfer-encoding', ''))
+        if version == 'HTTP/0.9':
+            pass
+        elif errcode in (204, 304) or 100 <= errcode < 200:
+            self.length = 0
+        elif 'chunked' in encoding:
+            self.chunked = ChunkedDecoder()
+        elif headers.has_key('content-length'):
+            try:
+                self.length = string.atoi(headers['content-length'])
+            except string.atoi_error:
+                pass
+        if self.length is None and not self.chunked:
+            # delimited by EOF
+            self.keepalive = 0
+        if self.length == 0:
+            self.finish_body()
+
+    def consume(self, data):
+        """Decode raw body data into pending; empty data means EOF."""
+        if not data:
+            self.keepalive = 0
+            self.finish_body()
+        elif self.chunked:
+            self.pending = self.pending + self.chunked.feed(data)
+            if self.chunked.done:
+                self.excess = self.chunked.extra
+                self.finish_body()
+        elif self.length is not None:
+            if len(data) >= self.length:
+                self.excess = data[self.length:]
+                self.pending = self.pending + data[:self.length]
+                self.length = 0
+                self.finish_body()
+            else:
+                self.length = self.length - len(data)
+                self.pending = self.pending + data
+        else:
+            self.pending = self.pending + data
+
+    def finish_body(self):
+        """The whole body has been read.
+
+        The socket is pooled by close(), not here: the reader still
+        has its file handler on it until then.
+        """
+        self.body_done = 1
+        self.reusable = self.keepalive and not self.excess
+
+    def receive(self, timeout=0):
+        """Read from the socket into pending until something is there.
+
+        Gives up after timeout seconds (0 to just poll, None to wait
+        as long as it takes).
+        """
+        while not self.pending and not self.body_done:
+            try:
+                if not select.select([self.h.sock], [], [], timeout)[0]:
+                    return
+            except select.error, msg:
+                raise IOError, msg, sys.exc_traceback
+            try:
+                data = self.h.sock.recv(BUFSIZE)
+            except socket.error, msg:
+                if msg.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise IOError, msg, sys.exc_traceback
+            self.consume(data)
+
     def polldata(self):
         Assert(self.state == DATA)
-        if self.readahead:
-            return "processing readahead data", 1
-        return ("waiting for data",
-                len(select.select([self], [], [], 0)[0]))
+        self.receive(0)
+        if self.pending:
+            return "reading data", 1
+        if self.body_done:
+            return "finished reading data", 1
+        return "waiting for data", 0
 
     def getdata(self, maxbytes):
         Assert(self.state == DATA)
-        if self.readahead:
-            data = self.readahead[:maxbytes]
-            self.readahead = self.readahead[maxbytes:]
+        self.receive(None)
+        if self.pending:
+            data = self.pending[:maxbytes]
+            self.pending = self.pending[maxbytes:]
             return data
-        try:
-            data = self.h.sock.recv(maxbytes)
-        except socket.error, msg:
-            raise IOError, msg, sys.exc_traceback
-        if not data:
-            self.state = DONE
-            # self.close()
-        return data
+        self.state = DONE
+        return ''
 
     def fileno(self):
-        return self.h.sock.fileno()
+        if self.h and self.h.sock:
+            return self.h.sock.fileno()
+        return -1
 
 
 # To test this, use ProtocolAPI.test()
@@ -463,7 +463,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
                     self.sgml_parser.lex_endtag(stack[0])
                     stack = self.sgml_parser.get_context('p')
                 # XXX this is really evil!
-                del self.sgml_parser.stack[-1]
+                self.sgml_parser.pop_element()
             return
         self.element_close_maybe('p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
         self.formatter.end_paragraph(parbreak)
@@ -488,7 +488,7 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
                 self.sgml_parser.lex_endtag(stack[0])
                 stack = self.sgml_parser.get_context('p')
             #  Remove <P> surgically:
-            del self.sgml_parser.stack[-1]
+            self.sgml_parser.pop_element()
             self.para_end(parbreak=0)
         else:
             self.formatter.add_line_break()
@@ -1035,7 +1035,48 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
     def unknown_endtag(self, tag):
         self.badhtml = 1
 
+    __taginfo_table = None
+
     def get_taginfo(self, tag):
+        table = self.__taginfo_table
+        if table is None:
+            table = self.__taginfo_table = self.get_taginfo_table()
+        try:
+            return table[tag]
+        except KeyError:
+            taginfo = table[tag] = self.find_taginfo(tag)
+            return taginfo
+
+    def get_taginfo_table(self):
+        """Return the tag dispatch table for this class and device types.
+
+        The table maps tag names to TagInfo objects (or None) and is
+        shared by all parsers of the same class and device types, so a
+        new document, frame or table cell does not repeat the lookups.
+        Tags handled by methods are entered when the table is built; tags
+        from extensions are added as they are first seen.  The tables are
+        dropped when the parsing-html preferences or the html.* loaders
+        change (see flush_taginfo_tables()).
+        """
+        key = (self.__class__, tuple(self.get_devicetypes()))
+        if _taginfo_tables.has_key(key):
+            return _taginfo_tables[key]
+        self.context.app.prefs.AddGroupCallback(
+            'parsing-html', flush_taginfo_tables)
+        table = {}
+        for name in dir(self.__class__):
+            parts = string.split(name, '_', 1)
+            if len(parts) == 2 and parts[0] in ('start', 'do') and parts[1]:
+                tag = parts[1]
+                if not table.has_key(tag):
+                    table[tag] = self.find_taginfo(tag)
+        for tag in self.UNIMPLEMENTED_CONTAINERS:
+            if not table.has_key(tag):
+                table[tag] = self.find_taginfo(tag)
+        _taginfo_tables[key] = table
+        return table
+
+    def find_taginfo(self, tag):
         override = self.context.app.prefs.GetBoolean(
             'parsing-html', 'override-builtin-tags')
         taginfo = None
@@ -1148,6 +1189,22 @@ class HTMLParser(SGMLHandler.BaseSGMLHandler):
             self.sgml_parser.lex_endtag('p')
 
 
+# Tag dispatch tables shared by all parsers of a class and set of device
+# types: (class, devicetypes) -> {tag: taginfo}.
+_taginfo_tables = {}
+
+def flush_taginfo_tables():
+    """Drop the shared tag dispatch tables.
+
+    Called when the parsing-html preferences or the html.* extension
+    loaders change.  Parsers already running keep their table, emptied
+    here, and refill it as tags are seen.
+    """
+    for table in _taginfo_tables.values():
+        table.clear()
+    _taginfo_tables.clear()
+
+
 class DummyTagInfo(SGMLParser.TagInfo):
     def __init__(self, tag):
         SGMLParser.TagInfo.__init__(self, tag, None, None, None)
@@ -97,6 +97,12 @@ class BaseSGMLHandler(ElementHandler):
         """
         pass
 
+    def report_unbalanced_tags(self, tags):
+        """Called by the parser with the unbalanced end tags seen since
+        its last report."""
+        for tag in tags:
+            self.report_unbalanced(tag)
+
 
 class CompositeHandler:
     """Compose two Handler-like classes into a composite form.
@@ -34,6 +34,7 @@ VI = "="                                # value indicator
 # data -- only char and entity references and end tags are special)
 # and CDATA (character data -- only end tags are special).
 
+import re
 import regex
 import string
 
@@ -221,7 +222,9 @@ class SGMLLexerBase:
         pass
 
 
-class SGMLLexer(SGMLLexerBase):
+class RegexSGMLLexer(SGMLLexerBase):
+    # The original lexer, built on the regex module.  It handles strict
+    # mode, literal sections and anything CompiledSGMLLexer defers.
     entitydefs = {}
     _in_parse = 0
     _finish_parse = 0
@@ -235,8 +238,25 @@ class SGMLLexer(SGMLLexerBase):
     def cleanup(self):
         pass
 
+    # The input buffer: rawdata[_offset:] has not been lexed yet, and
+    # data fed while the head of the buffer is an incomplete construct
+    # collects in _pending.  _waitfor, when set, holds characters at
+    # least one of which must arrive before that construct can be
+    # completed; until then feed() neither copies nor rescans the
+    # buffer.
     rawdata = ''
+    _offset = 0
+    _waitfor = None
+
+    # Incomplete constructs shorter than this are simply rescanned
+    WAIT_MINIMUM = 256
+
     def reset(self):
+        self.rawdata = ''
+        self._offset = 0
+        self._pending = []
+        self._waitfor = None
+        self._scan = None
         self.stack = []
         self.lasttag = '???'
         self.nomoretags = 0
@@ -255,13 +275,22 @@ class SGMLLexer(SGMLLexerBase):
         return None
 
     def feed(self, data):
-        self.rawdata = self.rawdata + data
-        if not self._in_parse:
-            self._in_parse = 1
-            self.goahead(0)
-            self._in_parse = 0
-            if self._finish_parse:
-                self.cleanup()
+        if self._in_parse:
+            # goahead() picks this up as it goes
+            self.rawdata = self.rawdata + data
+            return
+        self._pending.append(data)
+        if self._waitfor:
+            for c in self._waitfor:
+                if c in data:
+                    break
+            else:
+                return
+        self._in_parse = 1
+        self.goahead(0)
+        self._in_parse = 0
+        if self._finish_parse:
+            self.cleanup()
 
     def normalize(self, norm):
         prev = ((self._normfunc is string.lower) and 1) or 0
@@ -274,6 +303,7 @@ class SGMLLexer(SGMLLexerBase):
         return prev
 
     def setliteral(self, tag):
+        import regex                    # deleted from the module namespace
         self.literal = 1
         re = "%s%s[%s]*%s" % (ETAGO, tag, string.whitespace, TAGC)
         if self._normfunc is string.lower:
@@ -288,7 +318,8 @@ class SGMLLexer(SGMLLexerBase):
     # and data to be processed by a subsequent call.  If 'end' is
     # true, force handling all data as if followed by EOF marker.
     def goahead(self, end):
-        i = 0
+        self.fill()
+        i = self._offset
         n = len(self.rawdata)
         while i < n:
             rawdata = self.rawdata  # pick up any appended data
@@ -307,9 +338,12 @@ class SGMLLexer(SGMLLexerBase):
                     continue
                 else:
                     pos = string.rfind(rawdata, "<", i)
-                    if pos >= 0:
-                        self.lex_data(rawdata[i:pos])
-                        i = pos
+                    if pos < 0 or _lit_etag_prefix.match(rawdata, pos) \
+                                   != n - pos:
+                        # no end tag can start in what we have
+                        pos = n
+                    self.lex_data(rawdata[i:pos])
+                    i = pos
                 break
             # pick up self._finish_parse as soon as possible:
             end = end or self._finish_parse
@@ -434,7 +468,68 @@ class SGMLLexer(SGMLLexerBase):
         if (end or self._finish_parse) and i < n:
             self.lex_data(self.rawdata[i:n])
             i = n
-        self.rawdata = self.rawdata[i:]
+        if i >= len(self.rawdata):
+            self.rawdata = ''
+            self._scan = None
+            i = 0
+        elif n - i >= self.WAIT_MINIMUM and n == len(self.rawdata):
+            self._waitfor = self.waitfor(i)
+        self._offset = i
+
+    # Internal -- merge pending data into the buffer.
+    def fill(self):
+        if self._pending:
+            self.rawdata = self.rawdata[self._offset:] \
+                           + string.join(self._pending, '')
+            if self._scan:
+                start, pos = self._scan
+                self._scan = start - self._offset, pos - self._offset
+            self._offset = 0
+            self._pending = []
+        self._waitfor = None
+
+    # Internal -- return where to search for the end of the construct
+    # at i, normally pos; if an earlier pass found the same construct
+    # incomplete, the text it already searched is skipped.
+    def resume(self, i, pos):
+        if self._scan and self._scan[0] == i:
+            return max(pos, self._scan[1])
+        return pos
+
+    # Internal -- remember that the construct at i is incomplete and
+    # that no search for its end needs to start before pos.
+    def suspend(self, i, pos):
+        self._scan = i, pos
+
+    # Internal -- suspend() the comment at i: a comment close found
+    # later can only begin in the '-' and whitespace at the end of
+    # the buffer.
+    def suspend_comment(self, i):
+        rawdata = self.rawdata
+        k = len(rawdata)
+        while k > i+4 and rawdata[k-1] in string.whitespace:
+            k = k-1
+        while k > i+4 and rawdata[k-1] == '-':
+            k = k-1
+        self.suspend(i, k)
+
+    # Internal -- return the characters that must arrive before the
+    # incomplete construct at i can be completed, or None if any
+    # data might complete it.
+    def waitfor(self, i):
+        rawdata = self.rawdata
+        if self.nomoretags or self.literal or rawdata[i] != '<':
+            return None
+        if commentopen.match(rawdata, i) >= 0:
+            # the strict comment parser may end on any character
+            if not self._strict:
+                return MDC
+            return None
+        if endbracket.search(rawdata, self.resume(i, i+1)) < 0:
+            # tags, end tags and declarations all end at < or >
+            self.suspend(i, len(rawdata))
+            return '<>'
+        return None
 
     # Internal -- parse comment, return length or -1 if not terminated
     def parse_comment(self, i, end):
@@ -465,8 +560,9 @@ class SGMLLexer(SGMLLexerBase):
             map(self.lex_comment, comments)
             return pos + len(MDC) - i
         # not strict
-        j = commentclose.search(rawdata, i+4)
+        j = commentclose.search(rawdata, self.resume(i, i+4))
         if j < 0:
+            self.suspend_comment(i)
             if end:
                 if MDC in rawdata[i:]:
                     j = string.find(rawdata, MDC, i)
@@ -498,8 +594,9 @@ class SGMLLexer(SGMLLexerBase):
             self.lex_endtag(tag)
             return i + j
         # XXX The following should skip matching quotes (' or ")
-        j = endbracket.search(rawdata, i+1)
+        j = endbracket.search(rawdata, self.resume(i, i+1))
         if j < 0:
+            self.suspend(i, len(rawdata))
             return -1
         # Now parse the data between i+1 and j into a tag and attrs
         if rawdata[i:i+2] == '<>':
@@ -646,6 +743,178 @@ class SGMLLexer(SGMLLexerBase):
         return i - start
 
 
+class CompiledSGMLLexer(RegexSGMLLexer):
+    # Fast path for the non-strict (HTML) lexing done by Grail: the
+    # buffer is tokenized by the scanner of one compiled re alternation,
+    # which reads text, references and attribute-less tags as complete
+    # tokens and recognizes the start of every other construct; start
+    # tags with attributes are split with re as well.  The lex_* calls made are exactly those of
+    # RegexSGMLLexer.  Strict mode, literal sections, incomplete
+    # constructs at the end of the buffer and malformed start tags are
+    # handed to RegexSGMLLexer.
+
+    def goahead(self, end):
+        if self._strict or self.literal or self.nomoretags:
+            return RegexSGMLLexer.goahead(self, end)
+        self.fill()
+        i = self._offset
+        rawdata = self.rawdata
+        n = len(rawdata)
+        # Tokens are read off one scanner over the buffer; it is only
+        # restarted after markup whose end the handlers find themselves.
+        scan = _token.scanner(rawdata, i).match
+        while i < n:
+            if self.literal or self.nomoretags:
+                break
+            if self.rawdata is not rawdata:
+                # pick up any appended data
+                rawdata = self.rawdata
+                n = len(rawdata)
+                scan = _token.scanner(rawdata, i).match
+            m = scan()
+            if m is None:
+                # We get here only if incomplete matches but
+                # nothing else
+                j = _incomplete.match(rawdata, i).end()
+                if j == n:
+                    break # Really incomplete
+                self.lex_data(rawdata[i:j])
+                i = j
+                scan = _token.scanner(rawdata, i).match
+                continue
+            kind = m.lastgroup
+            if kind == 'text':
+                i = m.end()
+                self.lex_data(rawdata[m.start():i])
+                continue
+            if kind == 'simpletag':
+                i = m.end()
+                self.lex_starttag(self._normfunc(m.group('stag')), {})
+                continue
+            if kind == 'simpleendtag':
+                i = m.end()
+                self.lex_endtag(self._normfunc(m.group('etag')))
+                self.literal = 0
+                continue
+            if kind == 'starttag':
+                k = self.fast_starttag(i)
+                if k < 0: break
+                i = k
+            elif kind == 'endtag':
+                k = self.fast_endtag(i)
+                if k < 0: break
+                i = k
+                self.literal = 0
+            elif kind == 'comment':
+                c = _commentclose.search(rawdata, self.resume(i, i+4))
+                if c is None:
+                    self.suspend_comment(i)
+                    break
+                self.lex_comment(rawdata[i+4:c.start()])
+                i = c.end()
+            else:
+                i = m.end()
+                if kind == 'charref':
+                    name = m.group('charnum')
+                    terminator = m.group('charterm')
+                    postchar = ''
+                    if terminator == '\n':
+                        postchar = '\n'
+                        terminator = ''
+                    try:
+                        self.lex_charref(string.atoi(name), terminator)
+                    except ValueError:
+                        self.lex_data("&#%s%s" % (name, terminator))
+                    if postchar:
+                        self.lex_data(postchar)
+                elif kind == 'entityref':
+                    self.lex_entityref(m.group('entname'),
+                                       m.group('entterm'))
+                elif kind == 'empty':
+                    self.lex_data('<>')
+                elif kind == 'pi':
+                    self.lex_data('<')
+                elif m.end() - m.start() == 3:
+                    # special
+                    self.lex_declaration([])
+                continue
+            scan = _token.scanner(rawdata, i).match
+        # leave what remains to the full lexer
+        self._offset = i
+        RegexSGMLLexer.goahead(self, end)
+
+    # Internal -- handle starttag, return new index or -1 if not terminated
+    def fast_starttag(self, i):
+        rawdata = self.rawdata
+        b = _endbracket.search(rawdata, self.resume(i, i+1))
+        if b is None:
+            self.suspend(i, len(rawdata))
+            return -1
+        j = b.start()
+        m = _tagfind.match(rawdata, i+1)
+        k = m.end()
+        tag = self._normfunc(m.group())
+        # pull recognizable attributes
+        attrs = {}
+        while k < j:
+            m = _attrfind.match(rawdata, k)
+            if m is None: break
+            k = m.end()
+            attrname, rest, attrvalue = m.group(1, 2, 3)
+            if not rest:
+                attrvalue = None
+            elif attrvalue[:1] == LITA == attrvalue[-1:] or \
+                 attrvalue[:1] == LIT == attrvalue[-1:]:
+                attrvalue = attrvalue[1:-1]
+                if '&' in attrvalue:
+                    from SGMLReplacer import replace
+                    attrvalue = replace(attrvalue, self.entitydefs)
+            attrs[self._normfunc(attrname)] = attrvalue
+        # close the start-tag
+        m = _tagend.match(rawdata, k)
+        if m is None:
+            #  something vile; let the full lexer sort it out
+            return self.parse_starttag(i)
+        k = m.end() - 1
+        c = rawdata[k]
+        if c == '/':
+            if rawdata[k:k+2] == "/>":
+                # using XML empty-tag hack
+                self.lex_starttag(tag, attrs)
+                self.lex_endtag(tag)
+                return k + 2
+            else:
+                self.lex_starttag(tag, attrs)
+                return k + 1
+        if c == '>':
+            k = k + 1
+        self.lex_starttag(tag, attrs)
+        return k
+
+    # Internal -- handle endtag, return new index or -1 if not terminated
+    def fast_endtag(self, i):
+        rawdata = self.rawdata
+        c = rawdata[i+2]
+        if c == '<':
+            self.lex_limitation("unclosed end tags not supported")
+            self.lex_data(ETAGO)
+            return i + 2
+        if c == '>':
+            self.lex_endtag('')
+            return i + 3
+        m = _endtag.match(rawdata, i)
+        if m is None:
+            return -1
+        j = m.end() - 1
+        if rawdata[j] == TAGC:
+            j = j + 1
+        self.lex_endtag(self._normfunc(m.group(1)))
+        return j
+
+
+SGMLLexer = CompiledSGMLLexer
+
+
 # Regular expressions used for parsing:
 OPTIONAL_WHITESPACE = "[%s]*" % string.whitespace
 interesting = regex.compile('[&<]')
@@ -667,6 +936,8 @@ shorttag = regex.compile(STAGO + '\([a-zA-Z][a-zA-Z0-9.-]*\)'
                          + OPTIONAL_WHITESPACE + NET + '\([^/]*\)' + NET)
 endtagopen = regex.compile(ETAGO + '[<>a-zA-Z]')
 endbracket = regex.compile('[<>]')
+_lit_etag_prefix = regex.compile(ETAGO + '?[-.a-zA-Z0-9]*'
+                                 + OPTIONAL_WHITESPACE)
 endtag = regex.compile(ETAGO +
                        '\([a-zA-Z][-.a-zA-Z0-9]*\)'
                        '\([^-.<>a-zA-Z0-9]?[^<>]*\)[<>]')
@@ -700,6 +971,45 @@ comment_whitespace = regex.compile(OPTIONAL_WHITESPACE)
 
 del regex
 
+# re versions of the expressions above, for CompiledSGMLLexer's
+# non-strict lexing
+_WS = "[%s]*" % string.whitespace
+_token = re.compile(
+    '(?P<text>[^&<]+)'
+    # start and end tags without attributes are complete tokens
+    '|(?P<simpletag><(?P<stag>[a-zA-Z][a-zA-Z0-9.-]*)' + _WS + '>)'
+    '|(?P<simpleendtag></(?P<etag>[a-zA-Z][-.a-zA-Z0-9]*)'
+    '[^-.<>a-zA-Z0-9]?[^<>]*>)'
+    '|(?P<starttag><[a-zA-Z])'
+    '|(?P<empty><>)'
+    '|(?P<endtag></[<>a-zA-Z])'
+    '|(?P<comment><!--)'
+    '|(?P<pi><(?=\\?[^>]*>))'
+    '|(?P<special><![^>]*>)'
+    # a reference ends at ';' or newline (the terminator), or before
+    # any other character that cannot continue it
+    '|(?P<charref>&#(?P<charnum>[0-9]+)'
+    '(?P<charterm>[;\\n]|(?=[^0-9])))'
+    '|(?P<entityref>&(?P<entname>[a-zA-Z][-.a-zA-Z0-9]*)'
+    '(?P<entterm>[;\\n]|(?=[^-.a-zA-Z0-9])))')
+_incomplete = re.compile('&(?:[a-zA-Z][a-zA-Z0-9]*|#[0-9]*)?|'
+                         '<(?:[a-zA-Z][^<>]*|'
+                         '/(?:[a-zA-Z][^<>]*)?|'
+                         '![^<>]*)?')
+_commentclose = re.compile('--' + _WS + '>')
+_endbracket = re.compile('[<>]')
+_tagfind = re.compile('[a-zA-Z][a-zA-Z0-9.-]*')
+_attrfind = re.compile(
+    # comma is for compatibility
+    ('[%s,]*([a-zA-Z_][a-zA-Z_0-9.-]*)' % string.whitespace)
+    + '(' + _WS + '=' + _WS
+    + "('[^']*'"
+    + '|"[^"]*"'
+    + '|[-~a-zA-Z0-9,./:+*%?!()_#=]*))?')
+_tagend = re.compile(_WS + '[<>/]')
+_endtag = re.compile('</([a-zA-Z][-.a-zA-Z0-9]*)'
+                     '([^-.<>a-zA-Z0-9]?[^<>]*)[<>]')
+
 def comment_match(rawdata, start):
     """Match a legal SGML comment.
 
@@ -740,3 +1050,62 @@ def comment_match(rawdata, start):
         matcher = comment_segment
         matchlength = matcher.match(rawdata, pos)
     return -1, ''
+
+
+class _NullLexer:
+    # Minimal lex_* handlers, so the benchmark measures lexing only
+    def lex_data(self, data): pass
+    def lex_starttag(self, tagname, attributes): pass
+    def lex_endtag(self, tagname): pass
+    def lex_charref(self, ordinal, terminator): pass
+    def lex_namedcharref(self, refname, terminator): pass
+    def lex_entityref(self, refname, terminator): pass
+    def lex_pi(self, pi_data): pass
+    def lex_comment(self, comment_string): pass
+    def lex_declaration(self, declaration_info): pass
+    def lex_error(self, error_string): pass
+    def lex_limitation(self, limit_string): pass
+
+
+def benchmark(files, chunk=512, repeat=3):
+    """Compare the parse throughput of RegexSGMLLexer and
+    CompiledSGMLLexer over a corpus of saved pages, fed in chunk-byte
+    pieces the way BaseReader delivers them."""
+    import time
+    corpus = []
+    for file in files:
+        f = open(file, 'rb')
+        corpus.append(f.read())
+        f.close()
+    size = 0
+    for data in corpus:
+        size = size + len(data)
+    print "%d pages, %d bytes, fed %d bytes at a time" \
+          % (len(corpus), size, chunk)
+    for base in (RegexSGMLLexer, CompiledSGMLLexer):
+        class Lexer(_NullLexer, base):
+            pass
+        best = None
+        for r in range(repeat):
+            t0 = time.time()
+            for data in corpus:
+                lexer = Lexer()
+                lexer.restrict(1)
+                for i in range(0, len(data), chunk):
+                    lexer.feed(data[i:i+chunk])
+                lexer.close()
+            t = time.time() - t0
+            if best is None or t < best:
+                best = t
+        print "%-18s %.3f sec, %.2f MB/sec" \
+              % (base.__name__, best, size / best / (1024.0 * 1024.0))
+
+
+if __name__ == '__main__':
+    import sys
+    files = sys.argv[1:]
+    if not files:
+        import os
+        here = os.path.dirname(os.path.abspath(sys.argv[0]))
+        files = [os.path.join(here, os.pardir, 'data', 'about.html')]
+    benchmark(files)